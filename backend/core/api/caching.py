@@ -0,0 +1,8 @@
+import hashlib
+import json
+
+
+def dataset_cache_key(prefix, dataset, *parts):
+    # Keys carry the content version, so reprocessing a dataset orphans its old entries
+    digest = hashlib.md5(json.dumps(parts, default=str).encode()).hexdigest()
+    return f"{prefix}:{dataset.id}:v{dataset.data_version}:{digest}"
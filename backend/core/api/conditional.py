@@ -0,0 +1,35 @@
+import hashlib
+import json
+
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def dataset_etag(dataset, request, *parts):
+    """
+    Strong ETag for a representation of the dataset: the content version plus
+    everything else that changes the response body (query string, media type).
+    """
+    query = sorted(request.query_params.lists())
+    accepted = getattr(request, 'accepted_media_type', '')
+    key = json.dumps([dataset.id, dataset.data_version, query, accepted, *parts], default=str)
+    return quote_etag(f"ds{dataset.id}-v{dataset.data_version}-{hashlib.md5(key.encode()).hexdigest()[:16]}")
+
+
+def last_modified(dataset):
+    modified = dataset.data_updated_at or dataset.created_at
+    return int(modified.timestamp()) if modified else None
+
+
+def not_modified(request, etag, modified=None):
+    # Returns a 304 when the client copy is current, before any data queries run
+    return get_conditional_response(request._request, etag=etag, last_modified=modified)
+
+
+def add_validators(response, etag, modified=None):
+    response['ETag'] = etag
+    if modified:
+        response['Last-Modified'] = http_date(modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Authorization', 'Accept'])
+    return response
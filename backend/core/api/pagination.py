@@ -0,0 +1,17 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedCursorPagination(CursorPagination):
+    """
+    Keyset pagination: each page is a single indexed range scan with no
+    COUNT(*) and no OFFSET, so page cost does not grow with the list.
+    """
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+    ordering = ('-created_at', '-id')
+
+
+class UpdatedCursorPagination(CreatedCursorPagination):
+    ordering = ('-updated_at', '-id')
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from core.models import Profile, Project, Dataset
+from django.conf import settings
+from core.models import Profile, Project, Dataset, UploadSession, UploadPart
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -41,6 +42,9 @@ class ProjectSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at', 'updated_at']
 
     def get_dataset_count(self, obj):
+        # List/retrieve querysets annotate the count; only a freshly created project falls back to a query
+        if hasattr(obj, 'dataset_count'):
+            return obj.dataset_count
         return obj.datasets.count()
     
     def create(self, validated_data):
@@ -58,5 +62,50 @@ class DatasetUploadSerializer(serializers.ModelSerializer):
 class DatasetStatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = Dataset
-        fields = ['id', 'name', 'status', 'error_message', 'created_at', 'updated_at']
-        read_only_fields = ['created_at', 'updated_at']
+        fields = ['id', 'name', 'status', 'error_message', 'file_size_bytes', 'total_rows',
+                  'processing_started_at', 'processing_completed_at', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
+class UploadPartSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadPart
+        fields = ['part_number', 'size', 'checksum', 'created_at']
+
+
+class UploadInitiateSerializer(serializers.Serializer):
+    project = serializers.PrimaryKeyRelatedField(queryset=Project.objects.all())
+    name = serializers.CharField(max_length=255, required=False)
+    filename = serializers.CharField(max_length=255)
+    total_size = serializers.IntegerField(min_value=1)
+    part_size = serializers.IntegerField(required=False)
+    stream_ingest = serializers.BooleanField(default=False)
+
+    def validate_project(self, project):
+        if project.owner != self.context['request'].user:
+            raise serializers.ValidationError('Project not found')
+        return project
+
+    def validate_total_size(self, total_size):
+        if total_size > settings.UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Uploads are limited to {settings.UPLOAD_MAX_SIZE} bytes')
+        return total_size
+
+    def validate_part_size(self, part_size):
+        if not settings.UPLOAD_MIN_PART_SIZE <= part_size <= settings.UPLOAD_MAX_PART_SIZE:
+            raise serializers.ValidationError(
+                f'Part size must be between {settings.UPLOAD_MIN_PART_SIZE} and {settings.UPLOAD_MAX_PART_SIZE} bytes'
+            )
+        return part_size
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    upload_id = serializers.UUIDField(source='id', read_only=True)
+    dataset_id = serializers.IntegerField(source='dataset.id', read_only=True)
+    part_count = serializers.IntegerField(read_only=True)
+    parts = UploadPartSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ['upload_id', 'dataset_id', 'filename', 'total_size', 'part_size', 'part_count',
+                  'status', 'stream_ingest', 'parts', 'created_at', 'updated_at']
@@ -0,0 +1,59 @@
+from decimal import Decimal
+
+ANALYTICS_SHAPES = ['rows', 'columns', 'pivot']
+
+# Brand x year sections and the measure that fills the pivoted matrix
+PIVOT_SECTIONS = {
+    'sales_by_brand_year': 'total_sales',
+    'volume_by_brand_year': 'total_volume',
+    'yearly_comparison': 'total_sales',
+}
+
+
+def _plain(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def to_columns(rows):
+    if not rows:
+        return {}
+    return {column: [_plain(row[column]) for row in rows] for column in rows[0]}
+
+
+def to_pivot(rows, value_key, row_key='brand', column_key='year'):
+    """
+    Pivot rows into {row_key: [...], column_key: [...], value_key: matrix},
+    where matrix[i][j] is the value for the i-th row label and j-th column label.
+    Row labels keep the query order, column labels are sorted. Rows flagged
+    is_other stay apart from a real label of the same name.
+    """
+    row_keys = list(dict.fromkeys((row[row_key], bool(row.get('is_other'))) for row in rows))
+    column_labels = sorted({row[column_key] for row in rows})
+    row_index = {key: i for i, key in enumerate(row_keys)}
+    column_index = {label: j for j, label in enumerate(column_labels)}
+
+    matrix = [[None] * len(column_labels) for _ in row_keys]
+    for row in rows:
+        i = row_index[row[row_key], bool(row.get('is_other'))]
+        matrix[i][column_index[row[column_key]]] = _plain(row[value_key])
+
+    pivot = {row_key: [label for label, _ in row_keys], column_key: column_labels, value_key: matrix}
+    if any('is_other' in row for row in rows):
+        pivot['is_other'] = [is_other for _, is_other in row_keys]
+    return pivot
+
+
+def shape_analytics(response_data, shape):
+    if shape == 'rows':
+        return response_data
+
+    shaped = {}
+    for section, rows in response_data.items():
+        if not isinstance(rows, list):
+            shaped[section] = rows
+        elif shape == 'pivot' and section in PIVOT_SECTIONS:
+            shaped[section] = to_pivot(rows, PIVOT_SECTIONS[section])
+        else:
+            shaped[section] = to_columns(rows)
+    shaped['shape'] = shape
+    return shaped
@@ -4,15 +4,23 @@ from .views import (
     RegisterViewSet, 
     ProjectViewSet, 
     DatasetViewSet,
-    AnalyticsView
+    UploadViewSet,
+    AnalyticsView,
+    BatchAnalyticsView,
+    CorrelationView,
+    ExportView
 )
 
 router = DefaultRouter()
 router.register('register', RegisterViewSet, basename='register')
 router.register('projects', ProjectViewSet, basename='projects')
 router.register('datasets', DatasetViewSet, basename='datasets')
+router.register('uploads', UploadViewSet, basename='uploads')
 
 urlpatterns = [
     path('', include(router.urls)),
     path('datasets/<int:dataset_id>/analytics/', AnalyticsView.as_view(), name='analytics'),
+    path('datasets/<int:dataset_id>/analytics/batch/', BatchAnalyticsView.as_view(), name='analytics-batch'),
+    path('datasets/<int:dataset_id>/correlation/', CorrelationView.as_view(), name='correlation'),
+    path('datasets/<int:dataset_id>/export/', ExportView.as_view(), name='export'),
 ]
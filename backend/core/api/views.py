@@ -1,17 +1,44 @@
-from django.db import connection
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.contrib.auth.models import User
 from rest_framework import viewsets, status, views
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 
-from core.models import Dataset, Project, Profile
+from core.models import Dataset, Project, Profile, UploadSession, UploadPart
 from .serializers import (
     UserSerializer, ProjectSerializer, ProfileSerializer,
-    DatasetStatusSerializer, DatasetUploadSerializer
+    DatasetStatusSerializer, DatasetUploadSerializer,
+    UploadInitiateSerializer, UploadSessionSerializer
 )
-from core.tasks import process_and_store_data
+from core.tasks import enqueue_ingestion
+from core.exports import stream_csv, stream_parquet
+from core.correlation import build_matrix, correlation_sql, numeric_columns, subset_matrix
+from core.sampling import approx_sum_sql, sample_table
+from core.schema import NUMERIC_TYPES, PG_TYPES
+from core.trends import TREND_GRANULARITIES, lttb, trend_table, trend_total_table
+from core.uploads import UploadError, abort_upload, delete_upload_file, reserve_upload_file, write_part
+from .pagination import CreatedCursorPagination, UpdatedCursorPagination
+from .renderers import MessagePackRenderer
+from .shapes import ANALYTICS_SHAPES, shape_analytics
+from .caching import dataset_cache_key
+from .conditional import add_validators, dataset_etag, last_modified, not_modified
+
 
+# Label for the long-tail bucket and the rank cap used when only min_share is given
+OTHER_BRAND = 'Other'
+BRAND_RANK_LIMIT = 2147483647
 
 class RegisterViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -32,9 +59,16 @@ class RegisterViewSet(viewsets.ModelViewSet):
 class ProjectViewSet(viewsets.ModelViewSet):
     serializer_class = ProjectSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = UpdatedCursorPagination
 
     def get_queryset(self):
-        return self.request.user.projects.all().order_by('-updated_at')
+        queryset = self.request.user.projects.all().order_by('-updated_at', '-id')
+        if self.action in ['list', 'retrieve']:
+            # One query for the page with its counts and one for the dataset ids, however many projects
+            queryset = queryset.annotate(dataset_count=Count('datasets')).prefetch_related(
+                Prefetch('datasets', queryset=Dataset.objects.only('id', 'project_id'))
+            )
+        return queryset
 
     def perform_create(self, serializer):
         project = serializer.save(owner=self.request.user)
@@ -47,16 +81,21 @@ class ProjectViewSet(viewsets.ModelViewSet):
                 original_file=file,
                 status='pending'
             )
-            process_and_store_data.delay(dataset.id)
+            enqueue_ingestion(dataset)
             print(f"@ done -  [API] Project '{project.name}' created with dataset {dataset.id}")
 
 
 class DatasetViewSet(viewsets.ModelViewSet):
     serializer_class = DatasetUploadSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = CreatedCursorPagination
 
     def get_queryset(self):
-        return Dataset.objects.filter(project__owner=self.request.user).order_by('-created_at')
+        queryset = Dataset.objects.filter(project__owner=self.request.user).order_by('-created_at', '-id')
+        if self.action in ['list', 'retrieve']:
+            # Status responses never need the large ingestion artefacts
+            queryset = queryset.defer('data_profile', 'correlation_matrix', 'inferred_schema')
+        return queryset
 
     def get_serializer_class(self):
         if self.action in ['retrieve', 'list']:
@@ -65,16 +104,56 @@ class DatasetViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         dataset = serializer.save()
-        process_and_store_data.delay(dataset.id)
+        enqueue_ingestion(dataset)
+
+    def retrieve(self, request, *args, **kwargs):
+        dataset = self.get_object()
+        data = self.get_serializer(dataset).data
+        etag = dataset_etag(dataset, request, data)
+        modified = last_modified(dataset)
+
+        cached = not_modified(request, etag, modified)
+        if cached is not None:
+            return add_validators(cached, etag, modified)
+        return add_validators(Response(data), etag, modified)
+
+    @action(detail=True, methods=['get'], url_path='profile')
+    def profile(self, request, pk=None):
+        dataset = self.get_object()
+        if dataset.status not in Dataset.READY_STATUSES or not dataset.data_profile:
+            return Response({
+                'error': f'Profile not available. Status: {dataset.status}',
+                'status': dataset.status
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        etag = dataset_etag(dataset, request)
+        modified = last_modified(dataset)
+        cached = not_modified(request, etag, modified)
+        if cached is not None:
+            return add_validators(cached, etag, modified)
+
+        # Summaries were computed at ingestion; the raw sketches stay server-side
+        return add_validators(Response({
+            'dataset_id': dataset.id,
+            'row_count': dataset.data_profile['row_count'],
+            'unparsed_values': dataset.data_profile.get('unparsed_values', {}),
+            'columns': dataset.data_profile['columns'],
+        }), etag, modified)
 
     @action(detail=True, methods=['get'], url_path='filters')
     def filters(self, request, pk=None):
         
         dataset = self.get_object()
+        etag = dataset_etag(dataset, request, dataset.status)
+        modified = last_modified(dataset)
+        
+        cached = not_modified(request, etag, modified)
+        if cached is not None:
+            return add_validators(cached, etag, modified)
         
         print(f"📊 [FILTERS] Dataset {dataset.id}, status: {dataset.status}")
         
-        if dataset.status != 'completed':
+        if dataset.status not in Dataset.READY_STATUSES:
             return Response({
                 'status': dataset.status,
                 'brand': [],
@@ -84,31 +163,8 @@ class DatasetViewSet(viewsets.ModelViewSet):
                 'year': []
             })
         
-        raw_table = f"raw_data_{dataset.id}"
-        
         try:
-            with connection.cursor() as cursor:
-                filters = {}
-                # @ done -  All column names are lowercase
-                filter_columns = ['brand', 'packtype', 'ppg', 'channel', 'year']
-                
-                for column in filter_columns:
-                    try:
-                        # Use lowercase column names (no quotes needed)
-                        cursor.execute(f"""
-                            SELECT DISTINCT {column} 
-                            FROM {raw_table} 
-                            WHERE {column} IS NOT NULL 
-                            ORDER BY {column}
-                            LIMIT 500
-                        """)
-                        filters[column] = [row[0] for row in cursor.fetchall()]
-                        print(f"@ done -  [FILTERS] {column}: {len(filters[column])} values")
-                    except Exception as e:
-                        print(f"⚠️  {column}: {e}")
-                        filters[column] = []
-            
-            return Response(filters)
+            return add_validators(Response(get_filter_values(dataset)), etag, modified)
             
         except Exception as e:
             print(f"~~~ Error [FILTERS] Error: {e}")
@@ -121,46 +177,392 @@ class DatasetViewSet(viewsets.ModelViewSet):
             })
 
 
-class AnalyticsView(views.APIView):
+def get_filter_values(dataset):
+    cache_key = dataset_cache_key('filters', dataset)
+    filters = cache.get(cache_key)
+    if filters is not None:
+        return filters
+    
+    raw_table = f"raw_data_{dataset.id}"
     
+    with connection.cursor() as cursor:
+        filters = {}
+        # @ done -  All column names are lowercase
+        filter_columns = ['brand', 'packtype', 'ppg', 'channel', 'year']
+        
+        for column in filter_columns:
+            try:
+                # Use lowercase column names (no quotes needed)
+                cursor.execute(f"""
+                    SELECT DISTINCT {column} 
+                    FROM {raw_table} 
+                    WHERE {column} IS NOT NULL 
+                    ORDER BY {column}
+                    LIMIT 500
+                """)
+                filters[column] = [row[0] for row in cursor.fetchall()]
+                print(f"@ done -  [FILTERS] {column}: {len(filters[column])} values")
+            except Exception as e:
+                print(f"⚠️  {column}: {e}")
+                filters[column] = []
+    
+    cache.set(cache_key, filters, settings.ANALYTICS_CACHE_TIMEOUT)
+    return filters
+
+
+class UploadViewSet(viewsets.ViewSet):
+    """
+    Resumable chunked uploads: initiate, PUT numbered parts, then complete.
+    """
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, dataset_id):
+    def get_session(self, pk):
+        return get_object_or_404(
+            UploadSession.objects.select_related('dataset'), id=pk, owner=self.request.user
+        )
+
+    def create(self, request):
+        serializer = UploadInitiateSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        project = data['project']
+
+        file_name = reserve_upload_file(data['filename'], data['total_size'])
+        with transaction.atomic():
+            dataset = Dataset.objects.create(
+                project=project,
+                name=data.get('name') or f"{project.name}_dataset",
+                original_file=file_name,
+                status='uploading'
+            )
+            session = UploadSession.objects.create(
+                owner=request.user,
+                dataset=dataset,
+                filename=data['filename'],
+                total_size=data['total_size'],
+                part_size=data.get('part_size') or settings.UPLOAD_DEFAULT_PART_SIZE,
+                stream_ingest=data['stream_ingest']
+            )
+
+        if session.stream_ingest:
+            transaction.on_commit(lambda: enqueue_ingestion(dataset))
+
+        print(f"@ done -  [UPLOAD] Initiated upload {session.id} ({session.part_count} parts) for dataset {dataset.id}")
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk=None):
+        return Response(UploadSessionSerializer(self.get_session(pk)).data)
+
+    def destroy(self, request, pk=None):
+        session = self.get_session(pk)
+        if session.status == 'completed':
+            return Response({'error': 'Upload already completed'}, status=status.HTTP_409_CONFLICT)
+
+        if abort_upload(session, 'Upload aborted') and not session.stream_ingest:
+            delete_upload_file(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['put'], url_path=r'parts/(?P<part_number>[0-9]+)')
+    def parts(self, request, pk=None, part_number=None):
+        session = self.get_session(pk)
+        if session.status != 'active':
+            return Response({'error': f'Upload is {session.status}'}, status=status.HTTP_409_CONFLICT)
+
+        part_number = int(part_number)
+        content_length = request.META.get('CONTENT_LENGTH')
+        stream = request.stream
+        if stream is None:
+            return Response({'error': 'Empty part body'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            size, checksum = write_part(
+                session, part_number, stream,
+                int(content_length) if content_length else None,
+                request.headers.get('X-Checksum-SHA256'),
+                session.parts.filter(part_number=part_number).values_list('checksum', flat=True).first()
+            )
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # A verified retry replaces the stored part
+        UploadPart.objects.update_or_create(
+            session=session, part_number=part_number,
+            defaults={'size': size, 'checksum': checksum}
+        )
+        # Activity keeps the session from expiring
+        session.save(update_fields=['updated_at'])
+        return Response({'part_number': part_number, 'size': size, 'checksum': checksum})
+
+    @action(detail=True, methods=['post'], url_path='complete')
+    def complete(self, request, pk=None):
+        session = self.get_session(pk)
+        if session.status != 'active':
+            return Response({'error': f'Upload is {session.status}'}, status=status.HTTP_409_CONFLICT)
+
+        received = {part.part_number: part.checksum for part in session.parts.all()}
+        missing = [n for n in range(1, session.part_count + 1) if n not in received]
+        if missing:
+            return Response({'error': 'Upload has missing parts', 'missing_parts': missing},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Optional manifest of {part_number, checksum} to confirm against what the server stored
+        mismatched = [
+            part.get('part_number') for part in request.data.get('parts', [])
+            if received.get(part.get('part_number')) != str(part.get('checksum', '')).lower()
+        ]
+        if mismatched:
+            return Response({'error': 'Checksum mismatch', 'mismatched_parts': mismatched},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            session.status = 'completed'
+            session.save(update_fields=['status', 'updated_at'])
+            if not session.stream_ingest:
+                dataset = session.dataset
+                dataset.status = 'pending'
+                dataset.save(update_fields=['status'])
+                transaction.on_commit(lambda: enqueue_ingestion(dataset))
+
+        print(f"@ done -  [UPLOAD] Completed upload {session.id}")
+        return Response(UploadSessionSerializer(session).data)
+
+
+class DatasetQueryMixin:
+    """
+    Shared lookup, filter parsing and raw SQL helpers for views that query raw_data_{id}.
+    """
+
+    def get_ready_dataset(self, request, dataset_id):
+        # Returns (dataset, None) or (None, error response)
         try:
             dataset = Dataset.objects.get(id=dataset_id, project__owner=request.user)
         except Dataset.DoesNotExist:
-            return Response({'error': 'Dataset not found'}, status=status.HTTP_404_NOT_FOUND)
+            return None, Response({'error': 'Dataset not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        if dataset.status != 'completed':
-            return Response({
+        if dataset.status not in Dataset.READY_STATUSES:
+            return None, Response({
                 'error': f'Dataset not ready. Status: {dataset.status}',
                 'status': dataset.status
             }, status=status.HTTP_400_BAD_REQUEST)
+        return dataset, None
+
+    FILTER_PARAMS = [('brand', 'brand'), ('packType', 'packtype'), ('ppg', 'ppg'), ('channel', 'channel'),
+                     ('year', 'year')]
+
+    def get_filter_params(self, params, dataset=None):
+        # brand, pack_type, ppg, channel, year; empty values mean no filter
+        types = {column['name']: column['type'] for column in (dataset.inferred_schema if dataset else None) or []}
+        types.setdefault('year', 'integer')
+
+        values = []
+        for param, column in self.FILTER_PARAMS:
+            value = params.get(param)
+            if value in (None, ''):
+                value = None
+            elif types.get(column) in NUMERIC_TYPES:
+                # Typed columns are checked here so a bad value is a 400, not a failed query
+                kind = types[column]
+                try:
+                    number = float(value)
+                except (TypeError, ValueError):
+                    number = None
+                if number is None or not math.isfinite(number) or (kind != 'float' and not number.is_integer()):
+                    expected = 'a number' if kind == 'float' else 'an integer'
+                    raise ValidationError({'error': f'{param} must be {expected}'})
+                value = number if kind == 'float' else int(number)
+            values.append(value)
+        return tuple(values)
+
+    def _build_filters(self, brand, pack_type, ppg, channel, year):
+        
+        conditions = []
+        params = []
+        
+        if brand:
+            conditions.append('brand = %s')
+            params.append(brand)
+        if pack_type:
+            conditions.append('packtype = %s')
+            params.append(pack_type)
+        if ppg:
+            conditions.append('ppg = %s')
+            params.append(ppg)
+        if channel:
+            conditions.append('channel = %s')
+            params.append(channel)
+        if year:
+            conditions.append('year = %s')
+            params.append(int(year))
+        
+        return conditions, params
+
+    def _table_exists(self, table_name):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [table_name])
+            return cursor.fetchone()[0] is not None
+
+    def _execute_query(self, query, params):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                columns = [col[0] for col in cursor.description]
+                rows = cursor.fetchall()
+            return [dict(zip(columns, row)) for row in rows]
+        except Exception as e:
+            print(f"~~~ Error Query error: {e}")
+            return []
+
+
+class AnalyticsView(DatasetQueryMixin, views.APIView):
+    
+    permission_classes = [IsAuthenticated]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [MessagePackRenderer]
+
+    def get(self, request, dataset_id):
+        dataset, error = self.get_ready_dataset(request, dataset_id)
+        if error:
+            return error
+
+        # Opt-in compact layouts: column arrays, or brand x year matrices for the pivotable sections
+        shape = request.query_params.get('shape', 'rows')
+        if shape not in ANALYTICS_SHAPES:
+            return Response({'error': f'Unknown shape. Use one of: {", ".join(ANALYTICS_SHAPES)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # A completed dataset only changes when it is reprocessed, so the version decides freshness
+        etag = dataset_etag(dataset, request)
+        modified = last_modified(dataset)
+        cached = not_modified(request, etag, modified)
+        if cached is not None:
+            return add_validators(cached, etag, modified)
+
+        # Trend resolution and an optional cap on the number of points returned
+        granularity = request.query_params.get('granularity', 'day')
+        if granularity not in TREND_GRANULARITIES:
+            return Response({'error': f'Unknown granularity. Use one of: {", ".join(TREND_GRANULARITIES)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        max_points = request.query_params.get('max_points')
+        if max_points is not None:
+            if not max_points.isdigit() or int(max_points) < 3:
+                return Response({'error': 'max_points must be an integer of at least 3'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            max_points = int(max_points)
+
+        # Keep only the leading brands in brand-level sections, folding the rest into "Other"
+        try:
+            top_n = int(request.query_params['top_n']) if request.query_params.get('top_n') else None
+            min_share = float(request.query_params['min_share']) if request.query_params.get('min_share') else None
+        except ValueError:
+            return Response({'error': 'top_n must be an integer and min_share a number'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if (top_n is not None and top_n < 1) or (min_share is not None and not 0 <= min_share <= 100):
+            return Response({'error': 'top_n must be at least 1 and min_share between 0 and 100'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Fast preview from the stratified sample, with confidence intervals on every sum
+        approx = request.query_params.get('approx', '').lower() in ['1', 'true']
 
         # Get filter parameters
-        brand = request.query_params.get('brand')
-        pack_type = request.query_params.get('packType')
-        ppg = request.query_params.get('ppg')
-        channel = request.query_params.get('channel')
-        year = request.query_params.get('year')
+        brand, pack_type, ppg, channel, year = self.get_filter_params(request.query_params, dataset)
+
+        response_data = self.build_analytics(dataset, brand, pack_type, ppg, channel, year, granularity, max_points,
+                                             approx, top_n, min_share)
 
+        return add_validators(Response(shape_analytics(response_data, shape)), etag, modified)
+
+    def build_analytics(self, dataset, brand=None, pack_type=None, ppg=None, channel=None, year=None,
+                        granularity='day', max_points=None, approx=False, top_n=None, min_share=None):
+        # Cached per dataset version; the post-ingestion warm-up fills the common views
+        brand, pack_type, ppg, channel = brand or None, pack_type or None, ppg or None, channel or None
+        year = str(year) if year else None
+        approx = approx and self._table_exists(sample_table(dataset.id))
+        cache_key = dataset_cache_key('analytics', dataset, brand, pack_type, ppg, channel, year, granularity, max_points,
+                                      approx, top_n, min_share)
+        response_data = cache.get(cache_key)
+        if response_data is not None:
+            return response_data
+
+        if approx:
+            response_data = self.build_approx_analytics(dataset, brand, pack_type, ppg, channel, year,
+                                                        granularity, max_points)
+            cache.set(cache_key, response_data, settings.ANALYTICS_CACHE_TIMEOUT)
+            return response_data
+
+        dataset_id = dataset.id
         response_data = {
             'dataset_info': {'id': dataset.id, 'name': dataset.name},
-            'sales_by_brand_year': self.get_sales_by_brand_year(dataset_id, brand, pack_type, ppg, channel, year),
-            'volume_by_brand_year': self.get_volume_by_brand_year(dataset_id, brand, pack_type, ppg, channel, year),
+            'sales_by_brand_year': self.get_sales_by_brand_year(dataset_id, brand, pack_type, ppg, channel, year,
+                                                                top_n, min_share),
+            'volume_by_brand_year': self.get_volume_by_brand_year(dataset_id, brand, pack_type, ppg, channel, year,
+                                                                  top_n, min_share),
             'yearly_comparison': self.get_yearly_comparison(dataset_id, brand, pack_type, ppg, channel),
-            'monthly_trend': self.get_monthly_trend(dataset_id, brand, pack_type, ppg, channel, year),
-            'market_share': self.get_market_share(dataset_id, pack_type, ppg, channel, year)
+            'monthly_trend': self.get_monthly_trend(dataset_id, brand, pack_type, ppg, channel, year,
+                                                    granularity, max_points),
+            'market_share': self.get_market_share(dataset_id, pack_type, ppg, channel, year, top_n, min_share)
         }
+        cache.set(cache_key, response_data, settings.ANALYTICS_CACHE_TIMEOUT)
+        return response_data
+
+    def build_approx_analytics(self, dataset, brand, pack_type, ppg, channel, year, granularity, max_points):
+        table = sample_table(dataset.id)
+
+        def where(*filters):
+            conditions, params = self._build_filters(*filters)
+            return (' AND '.join(conditions) if conditions else '1=1'), params
+
+        brand_year = [('brand', 'brand'), ('year', 'year')]
+        where_clause, params = where(brand, pack_type, ppg, channel, year)
+        sales_by_brand_year = self._execute_query(approx_sum_sql(
+            table, brand_year, {'salesvalue': 'total_sales'}, where_clause, 'year, total_sales DESC'), params)
+        volume_by_brand_year = self._execute_query(approx_sum_sql(
+            table, brand_year, {'volume': 'total_volume'}, where_clause, 'year, total_volume DESC'), params)
 
-        return Response(response_data)
+        where_clause, params = where(brand, pack_type, ppg, channel, None)
+        yearly_comparison = self._execute_query(approx_sum_sql(
+            table, brand_year, {'salesvalue': 'total_sales'}, where_clause, 'brand, year'), params)
 
-    def get_sales_by_brand_year(self, dataset_id, brand, pack_type, ppg, channel, year):
+        where_clause, params = where(brand, pack_type, ppg, channel, year)
+        period = 'date' if granularity == 'day' else f"date_trunc('{granularity}', date)::date"
+        monthly_trend = self._execute_query(approx_sum_sql(
+            table,
+            [(period, 'date'), (f"EXTRACT(YEAR FROM {period})::int", 'year'),
+             (f"EXTRACT(MONTH FROM {period})::int", 'month')],
+            {'salesvalue': 'total_sales'}, f"{where_clause} AND date IS NOT NULL", 'date'), params)
+        if max_points:
+            monthly_trend = lttb(monthly_trend, max_points)
+
+        where_clause, params = where(None, pack_type, ppg, channel, year)
+        market_share = self._execute_query(approx_sum_sql(
+            table, [('brand', 'brand')], {'salesvalue': 'total_sales', 'volume': 'total_volume'},
+            where_clause, 'total_sales DESC'), params)
+        # Shares are ratios of estimates; the intervals stay on the sums
+        total_sales = sum(row['total_sales'] or 0 for row in market_share)
+        for row in market_share:
+            row['sales_share_pct'] = round(100 * row['total_sales'] / total_sales, 2) if total_sales else None
+
+        return {
+            'dataset_info': {'id': dataset.id, 'name': dataset.name},
+            'approximate': True,
+            'confidence_level': 0.95,
+            'sample_fraction': settings.APPROX_SAMPLE_FRACTION,
+            'sales_by_brand_year': sales_by_brand_year,
+            'volume_by_brand_year': volume_by_brand_year,
+            'yearly_comparison': yearly_comparison,
+            'monthly_trend': monthly_trend,
+            'market_share': market_share,
+        }
+
+    def get_sales_by_brand_year(self, dataset_id, brand, pack_type, ppg, channel, year, top_n=None, min_share=None):
         
         raw_table = f"raw_data_{dataset_id}"
         conditions, params = self._build_filters(brand, pack_type, ppg, channel, year)
         where_clause = ' AND '.join(conditions) if conditions else '1=1'
         
+        if top_n or min_share:
+            query, tail_params = self._brand_year_tail_query(raw_table, where_clause, 'salesvalue', 'total_sales',
+                                                             top_n, min_share)
+            return self._execute_query(query, params + tail_params)
+        
         query = f"""
         SELECT 
             brand,
@@ -173,12 +575,17 @@ class AnalyticsView(views.APIView):
         """
         return self._execute_query(query, params)
 
-    def get_volume_by_brand_year(self, dataset_id, brand, pack_type, ppg, channel, year):
+    def get_volume_by_brand_year(self, dataset_id, brand, pack_type, ppg, channel, year, top_n=None, min_share=None):
         
         raw_table = f"raw_data_{dataset_id}"
         conditions, params = self._build_filters(brand, pack_type, ppg, channel, year)
         where_clause = ' AND '.join(conditions) if conditions else '1=1'
         
+        if top_n or min_share:
+            query, tail_params = self._brand_year_tail_query(raw_table, where_clause, 'volume', 'total_volume',
+                                                             top_n, min_share)
+            return self._execute_query(query, params + tail_params)
+        
         query = f"""
         SELECT 
             brand,
@@ -191,6 +598,40 @@ class AnalyticsView(views.APIView):
         """
         return self._execute_query(query, params)
 
+    def _brand_year_tail_query(self, raw_table, where_clause, measure, alias, top_n, min_share):
+        # Brands are ranked on their total across all years so every year keeps the same brands;
+        # the rest collapse into one "Other" row per year, flagged is_other, and the sums stay exact
+        query = f"""
+        WITH grouped AS (
+            SELECT brand, year, SUM({measure}) as value
+            FROM {raw_table}
+            WHERE {where_clause}
+            GROUP BY brand, year
+        ), ranked AS (
+            SELECT 
+                brand,
+                year,
+                value,
+                dense_rank() OVER (ORDER BY brand_value DESC, brand) as brand_rank,
+                100.0 * brand_value / NULLIF(grand_value, 0) as brand_share
+            FROM (
+                SELECT *, SUM(value) OVER (PARTITION BY brand) as brand_value, SUM(value) OVER () as grand_value
+                FROM grouped
+            ) totals
+        )
+        SELECT 
+            CASE WHEN keep THEN brand ELSE %s END as brand,
+            year,
+            ROUND(SUM(value)::numeric, 2) as {alias},
+            NOT keep as is_other
+        FROM (
+            SELECT *, (brand_rank <= %s AND COALESCE(brand_share, 0) >= %s) as keep FROM ranked
+        ) marked
+        GROUP BY 1, year, keep
+        ORDER BY year, keep DESC, {alias} DESC
+        """
+        return query, [OTHER_BRAND, top_n or BRAND_RANK_LIMIT, min_share or 0]
+
     def get_yearly_comparison(self, dataset_id, brand, pack_type, ppg, channel):
 
         raw_table = f"raw_data_{dataset_id}"
@@ -209,32 +650,111 @@ class AnalyticsView(views.APIView):
         """
         return self._execute_query(query, params)
 
-    def get_monthly_trend(self, dataset_id, brand, pack_type, ppg, channel, year):
+    def get_monthly_trend(self, dataset_id, brand, pack_type, ppg, channel, year, granularity='day', max_points=None):
         
         raw_table = f"raw_data_{dataset_id}"
+        rollup_table = trend_table(dataset_id)
+        total_table = trend_total_table(dataset_id)
         conditions, params = self._build_filters(brand, pack_type, ppg, channel, year)
-        conditions.append('date IS NOT NULL')
-        where_clause = ' AND '.join(conditions)
         
-        query = f"""
-        SELECT 
-            date,
-            year,
-            month,
-            ROUND(SUM(salesvalue)::numeric, 2) as total_sales
-        FROM {raw_table}
-        WHERE {where_clause}
-        GROUP BY date, year, month
-        ORDER BY date
-        """
-        return self._execute_query(query, params)
+        if not conditions and self._table_exists(total_table):
+            params = [granularity]
+            query = f"""
+            SELECT 
+                period as date,
+                EXTRACT(YEAR FROM period)::int as year,
+                EXTRACT(MONTH FROM period)::int as month,
+                ROUND(total_sales::numeric, 2) as total_sales
+            FROM {total_table}
+            WHERE granularity = %s
+            ORDER BY period
+            """
+        elif self._table_exists(rollup_table):
+            # Precomputed at ingestion, so cost scales with periods rather than raw rows
+            conditions.insert(0, 'granularity = %s')
+            params.insert(0, granularity)
+            where_clause = ' AND '.join(conditions)
+            query = f"""
+            SELECT 
+                period as date,
+                EXTRACT(YEAR FROM period)::int as year,
+                EXTRACT(MONTH FROM period)::int as month,
+                ROUND(SUM(total_sales)::numeric, 2) as total_sales
+            FROM {rollup_table}
+            WHERE {where_clause}
+            GROUP BY period
+            ORDER BY period
+            """
+        elif granularity == 'day':
+            conditions.append('date IS NOT NULL')
+            where_clause = ' AND '.join(conditions)
+            query = f"""
+            SELECT 
+                date,
+                year,
+                month,
+                ROUND(SUM(salesvalue)::numeric, 2) as total_sales
+            FROM {raw_table}
+            WHERE {where_clause}
+            GROUP BY date, year, month
+            ORDER BY date
+            """
+        else:
+            conditions.append('date IS NOT NULL')
+            where_clause = ' AND '.join(conditions)
+            query = f"""
+            SELECT 
+                date_trunc('{granularity}', date)::date as date,
+                EXTRACT(YEAR FROM date_trunc('{granularity}', date))::int as year,
+                EXTRACT(MONTH FROM date_trunc('{granularity}', date))::int as month,
+                ROUND(SUM(salesvalue)::numeric, 2) as total_sales
+            FROM {raw_table}
+            WHERE {where_clause}
+            GROUP BY 1, 2, 3
+            ORDER BY 1
+            """
+        
+        rows = self._execute_query(query, params)
+        if max_points:
+            rows = lttb(rows, max_points)
+        return rows
 
-    def get_market_share(self, dataset_id, pack_type, ppg, channel, year):
+    def get_market_share(self, dataset_id, pack_type, ppg, channel, year, top_n=None, min_share=None):
         
         raw_table = f"raw_data_{dataset_id}"
         conditions, params = self._build_filters(None, pack_type, ppg, channel, year)
         where_clause = ' AND '.join(conditions) if conditions else '1=1'
         
+        if top_n or min_share:
+            # Rank in SQL and fold the long tail into a single "Other" row; shares use the exact total
+            query = f"""
+            WITH grouped AS (
+                SELECT brand, SUM(salesvalue) as sales, SUM(volume) as volume
+                FROM {raw_table}
+                WHERE {where_clause}
+                GROUP BY brand
+            ), ranked AS (
+                SELECT 
+                    *,
+                    row_number() OVER (ORDER BY sales DESC, brand) as brand_rank,
+                    SUM(sales) OVER () as grand_sales
+                FROM grouped
+            )
+            SELECT 
+                CASE WHEN keep THEN brand ELSE %s END as brand,
+                ROUND(SUM(sales)::numeric, 2) as total_sales,
+                ROUND(SUM(volume)::numeric, 2) as total_volume,
+                ROUND((100.0 * SUM(sales)::numeric / NULLIF(MAX(grand_sales)::numeric, 0)), 2) as sales_share_pct,
+                NOT keep as is_other
+            FROM (
+                SELECT *, (brand_rank <= %s AND COALESCE(100.0 * sales / NULLIF(grand_sales, 0), 0) >= %s) as keep
+                FROM ranked
+            ) marked
+            GROUP BY 1, keep
+            ORDER BY keep DESC, total_sales DESC
+            """
+            return self._execute_query(query, params + [OTHER_BRAND, top_n or BRAND_RANK_LIMIT, min_share or 0])
+        
         query = f"""
         SELECT 
             brand,
@@ -246,38 +766,273 @@ class AnalyticsView(views.APIView):
         GROUP BY brand
         ORDER BY total_sales DESC
         """
-        return self._execute_query(query, params)
+        return self._execute_query(query, params + params)
 
-    def _build_filters(self, brand, pack_type, ppg, channel, year):
-        
-        conditions = []
-        params = []
-        
-        if brand:
-            conditions.append('brand = %s')
-            params.append(brand)
-        if pack_type:
-            conditions.append('packtype = %s')
-            params.append(pack_type)
-        if ppg:
-            conditions.append('ppg = %s')
-            params.append(ppg)
-        if channel:
-            conditions.append('channel = %s')
-            params.append(channel)
-        if year:
-            conditions.append('year = %s')
-            params.append(int(year))
-        
-        return conditions, params
 
-    def _execute_query(self, query, params):
-        try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, params)
-                columns = [col[0] for col in cursor.description]
-                rows = cursor.fetchall()
-            return [dict(zip(columns, row)) for row in rows]
-        except Exception as e:
-            print(f"~~~ Error Query error: {e}")
-            return []
+class CorrelationView(DatasetQueryMixin, views.APIView):
+    """
+    Pearson correlation matrix over the numeric columns of a dataset. The
+    unfiltered matrix is precomputed at ingestion; filtered ones are cached
+    per dataset version.
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [MessagePackRenderer]
+
+    def get(self, request, dataset_id):
+        dataset, error = self.get_ready_dataset(request, dataset_id)
+        if error:
+            return error
+
+        available = numeric_columns(dataset.inferred_schema)
+        requested = request.query_params.get('columns')
+        columns = [c.strip().lower() for c in requested.split(',') if c.strip()] if requested else available
+        unknown = [c for c in columns if c not in available]
+        if unknown:
+            return Response({'error': f'Not numeric columns: {", ".join(unknown)}', 'columns': available},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(columns) < 2:
+            return Response({'error': 'At least two numeric columns are required', 'columns': available},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        etag = dataset_etag(dataset, request)
+        modified = last_modified(dataset)
+        cached = not_modified(request, etag, modified)
+        if cached is not None:
+            return add_validators(cached, etag, modified)
+
+        conditions, params = self._build_filters(*self.get_filter_params(request.query_params, dataset))
+        if not conditions and dataset.correlation_matrix:
+            result = subset_matrix(dataset.correlation_matrix, columns)
+        else:
+            cache_key = f"correlation:{dataset.id}:v{dataset.data_version}:{etag}"
+            result = cache.get(cache_key)
+            if result is None:
+                result = self.compute(dataset.id, columns, conditions, params)
+                cache.set(cache_key, result, settings.CORRELATION_CACHE_TIMEOUT)
+
+        return add_validators(Response(result), etag, modified)
+
+    def compute(self, dataset_id, columns, conditions, params):
+        where_clause = ' AND '.join(conditions) if conditions else '1=1'
+        query = correlation_sql(f"raw_data_{dataset_id}", columns, where_clause)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+        return build_matrix(columns, row)
+
+
+class ExportView(DatasetQueryMixin, views.APIView):
+    """
+    Stream the filtered raw data as CSV (optionally gzipped) or Parquet.
+    Rows are never materialised in the request, so memory stays flat
+    regardless of dataset size.
+    """
+    permission_classes = [IsAuthenticated]
+    EXPORT_OUTPUTS = ['csv', 'parquet']
+
+    def get(self, request, dataset_id):
+        dataset, error = self.get_ready_dataset(request, dataset_id)
+        if error:
+            return error
+
+        output = request.query_params.get('output', 'csv')
+        if output not in self.EXPORT_OUTPUTS:
+            return Response({'error': f'output must be one of: {", ".join(self.EXPORT_OUTPUTS)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        compress = request.query_params.get('compression') == 'gzip'
+
+        conditions, params = self._build_filters(*self.get_filter_params(request.query_params, dataset))
+        where_clause = ' AND '.join(conditions) if conditions else '1=1'
+        query = f"SELECT * FROM raw_data_{dataset.id} WHERE {where_clause}"
+
+        filename = f"dataset_{dataset.id}"
+        if output == 'parquet':
+            response = StreamingHttpResponse(stream_parquet(query, params, dataset.inferred_schema),
+                                             content_type='application/vnd.apache.parquet')
+            filename += '.parquet'
+        else:
+            response = StreamingHttpResponse(stream_csv(query, params, compress=compress),
+                                             content_type='application/gzip' if compress else 'text/csv')
+            filename += '.csv.gz' if compress else '.csv'
+
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        print(f">>>> Exporting dataset {dataset.id} as {filename}")
+        return response
+
+
+class BatchAnalyticsView(DatasetQueryMixin, views.APIView):
+    """
+    Evaluates many filter sets in one request. Filter sets that constrain the
+    same dimensions share one scan, equality-joined against a VALUES list of
+    their filter values and grouped by request index, instead of one scan per
+    filter set. Results stream back as NDJSON, one line per (index, section).
+    """
+    permission_classes = [IsAuthenticated]
+
+    SECTIONS = ['sales_by_brand_year', 'volume_by_brand_year', 'yearly_comparison', 'monthly_trend', 'market_share']
+    DIMENSIONS = ['brand', 'packtype', 'ppg', 'channel', 'year']
+
+    def post(self, request, dataset_id):
+        dataset, error = self.get_ready_dataset(request, dataset_id)
+        if error:
+            return error
+
+        filter_sets = request.data.get('filters')
+        if not isinstance(filter_sets, list) or not filter_sets or not all(isinstance(f, dict) for f in filter_sets):
+            return Response({'error': 'filters must be a non-empty list of filter objects'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(filter_sets) > settings.BATCH_ANALYTICS_MAX_REQUESTS:
+            return Response({'error': f'At most {settings.BATCH_ANALYTICS_MAX_REQUESTS} filter sets per batch'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        sections = request.data.get('sections') or self.SECTIONS
+        unknown = [section for section in sections if section not in self.SECTIONS]
+        if unknown:
+            return Response({'error': f'Unknown sections: {", ".join(map(str, unknown))}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        requests = [self.get_filter_params(filter_set, dataset) for filter_set in filter_sets]
+
+        # Join on the dimensions the dataset actually has, compared in their stored types
+        types = {column['name']: column['type'] for column in dataset.inferred_schema or []}
+        self.dimension_types = {name: types[name] for name in self.DIMENSIONS if name in types}
+
+        response = StreamingHttpResponse(
+            self.stream(dataset.id, requests, sections), content_type='application/x-ndjson'
+        )
+        response['X-Batch-Size'] = str(len(requests))
+        return response
+
+    def stream(self, dataset_id, requests, sections):
+        # sales and volume by brand/year share one scan
+        if 'sales_by_brand_year' in sections or 'volume_by_brand_year' in sections:
+            rows = self.run(self.brand_year_query(dataset_id), requests)
+            for section, measure in [('sales_by_brand_year', 'total_sales'), ('volume_by_brand_year', 'total_volume')]:
+                if section in sections:
+                    # Same order as the single-request endpoint: year, then the section's measure descending
+                    rows.sort(key=lambda row: (row['idx'], row['year'] is None, row['year'] or 0,
+                                               row[measure] is not None, -(row[measure] or 0)))
+                    yield from self.emit(section, len(requests), rows, ['brand', 'year', measure])
+
+        if 'yearly_comparison' in sections:
+            without_year = [(b, p, g, c, None) for b, p, g, c, _ in requests]
+            rows = self.run(self.yearly_comparison_query(dataset_id), without_year)
+            yield from self.emit('yearly_comparison', len(requests), rows, ['brand', 'year', 'total_sales'])
+
+        if 'monthly_trend' in sections:
+            rows = self.run(self.monthly_trend_query(dataset_id), requests)
+            yield from self.emit('monthly_trend', len(requests), rows, ['date', 'year', 'month', 'total_sales'])
+
+        if 'market_share' in sections:
+            without_brand = [(None, p, g, c, y) for _, p, g, c, y in requests]
+            rows = self.run(self.market_share_query(dataset_id), without_brand)
+            yield from self.emit('market_share', len(requests), rows,
+                                 ['brand', 'total_sales', 'total_volume', 'sales_share_pct'])
+
+    def emit(self, section, count, rows, fields):
+        by_index = {}
+        for row in rows:
+            by_index.setdefault(row['idx'], []).append({field: row[field] for field in fields})
+        for index in range(count):
+            line = {'index': index, 'section': section, 'data': by_index.get(index, [])}
+            yield json.dumps(line, cls=JSONEncoder) + '\n'
+
+    def run(self, query, requests):
+        # Group filter sets by the dimensions they use, so every join condition is a plain equality
+        groups = {}
+        for index, request in enumerate(requests):
+            used = tuple(i for i, value in enumerate(request) if value is not None)
+            groups.setdefault(used, []).append(index)
+
+        rows = []
+        for used, indexes in groups.items():
+            names = [self.DIMENSIONS[i] for i in used]
+            # A filter on a column the dataset lacks matches nothing
+            if any(name not in self.dimension_types for name in names):
+                continue
+            casts = ''.join(f", %s::{PG_TYPES[self.dimension_types[name]]}" for name in names)
+            values = ', '.join([f'(%s::int{casts})'] * len(indexes))
+            params = [value for index in indexes for value in (index, *(requests[index][i] for i in used))]
+            rows += self._execute_query(query.replace('{join}', self._join(names, values)), params)
+        return rows
+
+    def _join(self, names, values, alias='t'):
+        conditions = ' AND '.join(f"{alias}.{name} = r.{name}" for name in names) or 'TRUE'
+        return f"""
+        JOIN (VALUES {values}) AS r({', '.join(['idx', *names])})
+          ON {conditions}
+        """
+
+    def brand_year_query(self, dataset_id):
+        return f"""
+        SELECT 
+            r.idx,
+            t.brand,
+            t.year,
+            ROUND(SUM(t.salesvalue)::numeric, 2) as total_sales,
+            ROUND(SUM(t.volume)::numeric, 2) as total_volume
+        FROM raw_data_{dataset_id} t
+        {{join}}
+        GROUP BY r.idx, t.brand, t.year
+        ORDER BY r.idx, t.year, total_sales DESC
+        """
+
+    def yearly_comparison_query(self, dataset_id):
+        return f"""
+        SELECT 
+            r.idx,
+            t.brand,
+            t.year,
+            ROUND(SUM(t.salesvalue)::numeric, 2) as total_sales
+        FROM raw_data_{dataset_id} t
+        {{join}}
+        GROUP BY r.idx, t.brand, t.year
+        ORDER BY r.idx, t.brand, t.year
+        """
+
+    def monthly_trend_query(self, dataset_id):
+        rollup_table = trend_table(dataset_id)
+        if self._table_exists(rollup_table):
+            return f"""
+            SELECT 
+                r.idx,
+                t.period as date,
+                EXTRACT(YEAR FROM t.period)::int as year,
+                EXTRACT(MONTH FROM t.period)::int as month,
+                ROUND(SUM(t.total_sales)::numeric, 2) as total_sales
+            FROM {rollup_table} t
+            {{join}}
+            WHERE t.granularity = 'day'
+            GROUP BY r.idx, t.period
+            ORDER BY r.idx, t.period
+            """
+        return f"""
+        SELECT 
+            r.idx,
+            t.date,
+            t.year,
+            t.month,
+            ROUND(SUM(t.salesvalue)::numeric, 2) as total_sales
+        FROM raw_data_{dataset_id} t
+        {{join}}
+        WHERE t.date IS NOT NULL
+        GROUP BY r.idx, t.date, t.year, t.month
+        ORDER BY r.idx, t.date
+        """
+
+    def market_share_query(self, dataset_id):
+        return f"""
+        SELECT 
+            idx,
+            brand,
+            ROUND(sales::numeric, 2) as total_sales,
+            ROUND(volume::numeric, 2) as total_volume,
+            ROUND((100.0 * sales::numeric / NULLIF(SUM(sales) OVER (PARTITION BY idx)::numeric, 0)), 2) as sales_share_pct
+        FROM (
+            SELECT r.idx, t.brand, SUM(t.salesvalue) as sales, SUM(t.volume) as volume
+            FROM raw_data_{dataset_id} t
+            {{join}}
+            GROUP BY r.idx, t.brand
+        ) per_brand
+        ORDER BY idx, total_sales DESC
+        """
@@ -0,0 +1,41 @@
+import math
+
+from .schema import NUMERIC_TYPES, quote_identifier
+
+
+def numeric_columns(schema):
+    return [column['name'] for column in schema or [] if column['type'] in NUMERIC_TYPES]
+
+
+def correlation_sql(raw_table, columns, where_clause='1=1'):
+    """
+    One scan computing every pairwise Pearson coefficient. Postgres corr()
+    accumulates count, sums, sums of squares and cross-products per pair with
+    a numerically stable update, so nothing but the aggregates leaves the database.
+    """
+    aggregates = ['COUNT(*)']
+    for i, x in enumerate(columns):
+        for y in columns[i + 1:]:
+            aggregates.append(f"corr({quote_identifier(x)}, {quote_identifier(y)})")
+    return f"SELECT {', '.join(aggregates)} FROM {raw_table} WHERE {where_clause}"
+
+
+def build_matrix(columns, row):
+    row_count, values = row[0], iter(row[1:])
+    size = len(columns)
+    matrix = [[1.0 if i == j else None for j in range(size)] for i in range(size)]
+    for i in range(size):
+        for j in range(i + 1, size):
+            value = next(values)
+            if value is not None and not math.isnan(value):
+                matrix[i][j] = matrix[j][i] = round(float(value), 6)
+    return {'columns': columns, 'row_count': row_count, 'matrix': matrix}
+
+
+def subset_matrix(result, columns):
+    index = [result['columns'].index(column) for column in columns]
+    return {
+        'columns': columns,
+        'row_count': result['row_count'],
+        'matrix': [[result['matrix'][i][j] for j in index] for i in index],
+    }
@@ -0,0 +1,173 @@
+import queue
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connection
+
+ARROW_TYPES = {
+    'category': 'string',
+    'text': 'string',
+    'date': 'date32',
+    'smallint': 'int16',
+    'integer': 'int32',
+    'bigint': 'int64',
+    'float': 'float64',
+}
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    """
+    File-like sink for copy_expert. Buffers COPY output into fixed-size blocks
+    and hands them to a bounded queue, so a slow client applies backpressure
+    to Postgres instead of the rows piling up in memory.
+    """
+
+    def __init__(self, blocks, cancelled):
+        self.blocks = blocks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data.encode() if isinstance(data, str) else data
+        if len(self.buffer) >= settings.EXPORT_CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.blocks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_csv(query, params, compress=False):
+    """
+    Stream COPY (query) TO STDOUT as CSV blocks. The copy runs on its own
+    connection in a worker thread while the response iterates the queue.
+    """
+    with connection.cursor() as cursor:
+        # COPY does not take bind parameters, so inline them with driver-side quoting
+        copy_sql = f"COPY ({cursor.mogrify(query, params).decode()}) TO STDOUT WITH CSV HEADER"
+
+    blocks = queue.Queue(maxsize=settings.EXPORT_QUEUE_BLOCKS)
+    cancelled = threading.Event()
+    done = object()
+
+    def run():
+        writer = _QueueWriter(blocks, cancelled)
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(copy_sql, writer)
+            writer.flush()
+        except ExportCancelled:
+            return
+        except Exception as e:
+            print(f"~~~ Error [EXPORT] {e}")
+            writer.put(e)
+        finally:
+            connection.close()
+        writer.put(done)
+
+    def blocks_from_queue():
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = blocks.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+
+    return _gzip(blocks_from_queue()) if compress else blocks_from_queue()
+
+
+class _DrainBuffer:
+    # Append-only sink for ParquetWriter that hands back whatever was written since the last drain
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def stream_parquet(query, params, schema):
+    """
+    Stream the query as Parquet, fetching one row group at a time through a
+    server-side cursor and flushing each group as soon as it is written.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('Parquet export requires the pyarrow package')
+
+    types = {column['name']: getattr(pa, ARROW_TYPES[column['type']])() for column in schema or []}
+
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name='dataset_export', withhold=True)
+    sink = _DrainBuffer()
+    try:
+        cursor.execute(query, params)
+        rows = cursor.fetchmany(settings.EXPORT_PARQUET_ROW_GROUP)
+        names = [col[0] for col in cursor.description]
+
+        def to_table(rows):
+            return pa.Table.from_pydict({name: [row[i] for row in rows] for i, name in enumerate(names)}, schema=arrow_schema)
+
+        # Columns missing from the stored schema take their type from the first row group
+        arrow_schema = pa.schema([
+            (name, types.get(name) or pa.array([row[i] for row in rows]).type) for i, name in enumerate(names)
+        ])
+        writer = pq.ParquetWriter(sink, arrow_schema)
+        while rows:
+            writer.write_table(to_table(rows))
+            yield sink.drain()
+            rows = cursor.fetchmany(settings.EXPORT_PARQUET_ROW_GROUP)
+        writer.close()
+        yield sink.drain()
+    finally:
+        cursor.close()
@@ -0,0 +1,84 @@
+import bz2
+import gzip
+from contextlib import contextmanager
+
+import pandas as pd
+
+from .uploads import get_streaming_session, open_upload_stream
+
+CHUNK_ROWS = 100000
+
+MAGIC_BYTES = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'PAR1', 'parquet'),
+]
+
+
+def detect_format(head):
+    for magic, fmt in MAGIC_BYTES:
+        if head.startswith(magic):
+            return fmt
+    return 'csv'
+
+
+@contextmanager
+def open_dataset_source(dataset):
+    # Binary stream over the upload, following a chunked upload that is still in progress
+    session = get_streaming_session(dataset)
+    if session:
+        print(f"@ done -  [CELERY] Streaming upload {session.id} into parser")
+        with open_upload_stream(session) as stream:
+            yield stream
+    else:
+        with open(dataset.original_file.path, 'rb') as stream:
+            yield stream
+
+
+def _decompress(stream, fmt):
+    if fmt == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if fmt == 'bz2':
+        return bz2.BZ2File(stream, mode='rb')
+    if fmt == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd input requires the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    return stream
+
+
+def _iter_parquet(dataset, stream, chunk_rows):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('Parquet input requires the pyarrow package')
+
+    # The footer is at the end of the file, so a streaming upload has to land completely first
+    if get_streaming_session(dataset):
+        while stream.read(1024 * 1024):
+            pass
+
+    parquet_file = pq.ParquetFile(dataset.original_file.path)
+    print(f"@ done -  [CELERY] Reading {parquet_file.metadata.num_row_groups} parquet row groups")
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+        yield batch.to_pandas()
+
+
+def iter_dataframes(dataset, stream, chunk_rows=CHUNK_ROWS, **read_csv_kwargs):
+    """
+    Yield the dataset as DataFrames of at most chunk_rows rows. Compressed CSVs
+    are decompressed on the fly and Parquet is read batch by batch, so memory
+    is bounded by the chunk size rather than the file size.
+    """
+    fmt = detect_format(stream.peek(4)[:4])
+    print(f"@ done -  [CELERY] Detected input format: {fmt}")
+
+    if fmt == 'parquet':
+        yield from _iter_parquet(dataset, stream, chunk_rows)
+        return
+
+    with _decompress(stream, fmt) as source:
+        yield from pd.read_csv(source, chunksize=chunk_rows, **read_csv_kwargs)
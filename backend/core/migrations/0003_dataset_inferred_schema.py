@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 08:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='inferred_schema',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
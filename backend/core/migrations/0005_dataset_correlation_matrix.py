@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_dataset_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='correlation_matrix',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-19 08:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_dataset_warming_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['project', '-created_at', '-id'], name='dataset_project_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='project',
+            index=models.Index(fields=['owner', '-updated_at', '-id'], name='project_owner_updated_idx'),
+        ),
+    ]
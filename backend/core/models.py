@@ -1,5 +1,9 @@
+import math
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
@@ -33,11 +37,17 @@ class Project(models.Model):
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [models.Index(fields=['owner', '-updated_at', '-id'], name='project_owner_updated_idx')]
 
 class Dataset(models.Model):
+    # Statuses in which the dataset tables are fully written and queryable
+    READY_STATUSES = ['warming', 'completed']
+
     STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
         ('pending', 'Pending'),
         ('processing', 'Processing'),
+        ('warming', 'Completed (warming caches)'),
         ('completed', 'Completed'),
         ('failed', 'Failed'),
     ]
@@ -47,11 +57,24 @@ class Dataset(models.Model):
     original_file = models.FileField(upload_to='raw_datasets/')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     error_message = models.TextField(blank=True, null=True)
+    file_size_bytes = models.BigIntegerField(null=True, blank=True)
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    processing_completed_at = models.DateTimeField(null=True, blank=True)
     
     # Analytics metadata
     total_rows = models.IntegerField(default=0)
     date_range_start = models.DateField(null=True, blank=True)
     date_range_end = models.DateField(null=True, blank=True)
+    # Column names, sources and types inferred from a sample of the file
+    inferred_schema = models.JSONField(null=True, blank=True)
+    # Unfiltered correlation matrix of the numeric columns, computed at ingestion
+    correlation_matrix = models.JSONField(null=True, blank=True)
+    # Per-column summaries and their mergeable sketches, built in the ingestion pass
+    data_profile = models.JSONField(null=True, blank=True)
+
+    # Content version, bumped whenever processing rewrites the dataset tables
+    data_version = models.PositiveIntegerField(default=0)
+    data_updated_at = models.DateTimeField(null=True, blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -59,5 +82,72 @@ class Dataset(models.Model):
     def __str__(self):
         return f"{self.name} ({self.status})"
 
+    def mark_data_changed(self):
+        self.data_version += 1
+        self.data_updated_at = timezone.now()
+        return ['data_version', 'data_updated_at']
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['project', '-created_at', '-id'], name='dataset_project_created_idx')]
+
+
+class UploadSession(models.Model):
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('completed', 'Completed'),
+        ('aborted', 'Aborted'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    dataset = models.OneToOneField(Dataset, on_delete=models.CASCADE, related_name='upload_session')
+    filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    part_size = models.IntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+    # Let the ingestion task parse leading parts while the rest is still uploading
+    stream_ingest = models.BooleanField(default=False)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.id} for {self.filename} ({self.status})"
+
+    @property
+    def part_count(self):
+        return max(1, math.ceil(self.total_size / self.part_size))
+
+    def part_offset(self, part_number):
+        return (part_number - 1) * self.part_size
+
+    def expected_part_length(self, part_number):
+        return min(self.part_size, self.total_size - self.part_offset(part_number))
+
+    def received_prefix_bytes(self):
+        # Bytes available from the start of the file without gaps
+        expected = 1
+        for number in self.parts.order_by('part_number').values_list('part_number', flat=True):
+            if number != expected:
+                break
+            expected += 1
+        return min(self.total_size, (expected - 1) * self.part_size)
+
+    class Meta:
+        ordering = ['-created_at']
+
+
+class UploadPart(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='parts')
+    part_number = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Part {self.part_number} of upload {self.session_id}"
+
+    class Meta:
+        ordering = ['part_number']
+        unique_together = ('session', 'part_number')
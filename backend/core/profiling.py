@@ -0,0 +1,356 @@
+import base64
+import datetime
+import math
+
+import numpy as np
+import pandas as pd
+
+from .schema import NUMERIC_TYPES
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+HISTOGRAM_BINS = 20
+TOP_K = 10
+# Numeric columns with at most this many distinct values keep exact counts for their histogram
+EXACT_VALUES = 1000
+
+
+class HyperLogLog:
+    """
+    Approximate distinct counter. Registers merge with an elementwise max, so
+    sketches built over separate chunks or workers combine exactly.
+    """
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else np.zeros(self.size, dtype=np.uint8)
+
+    def update(self, series):
+        if series.empty:
+            return
+        hashes = pd.util.hash_pandas_object(series, index=False).to_numpy(dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        remainder = (hashes << np.uint64(self.precision)) | np.uint64((1 << self.precision) - 1)
+        # Rank is the position of the leftmost set bit in the remaining 64 - p bits
+        rank = np.clip(64 - np.floor(np.log2(remainder.astype(np.float64))), 1, 64 - self.precision + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        raw = alpha * self.size ** 2 / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * self.size and zeros:
+            return int(round(self.size * math.log(self.size / zeros)))
+        return int(round(raw))
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': base64.b64encode(self.registers.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        registers = np.frombuffer(base64.b64decode(data['registers']), dtype=np.uint8).copy()
+        return cls(data['precision'], registers)
+
+
+class QuantileSketch:
+    """
+    t-digest style quantile sketch: weighted centroids kept small in the tails
+    and coarse in the middle. Merging two sketches re-compresses their centroids.
+    """
+
+    def __init__(self, compression=200, means=None, weights=None):
+        self.compression = compression
+        self.means = np.asarray(means if means is not None else [], dtype=np.float64)
+        self.weights = np.asarray(weights if weights is not None else [], dtype=np.float64)
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def update(self, values):
+        values = np.sort(values[~np.isnan(values)])
+        if not len(values):
+            return
+        # Pre-summarise the chunk into equal-count groups before the scalar merge
+        groups = min(len(values), self.compression * 4)
+        starts = np.linspace(0, len(values), groups, endpoint=False).astype(np.int64)
+        sums = np.add.reduceat(values, starts)
+        weights = np.diff(np.append(starts, len(values))).astype(np.float64)
+        self._compress(np.concatenate([self.means, sums / weights]), np.concatenate([self.weights, weights]))
+
+    def merge(self, other):
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+
+    def _compress(self, means, weights):
+        if not len(means):
+            return
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+
+        merged_means, merged_weights = [], []
+        cumulative = 0.0
+        current_mean, current_weight = means[0], weights[0]
+        for mean, weight in zip(means[1:], weights[1:]):
+            q = (cumulative + (current_weight + weight) / 2) / total
+            limit = max(1.0, 4 * total * q * (1 - q) / self.compression)
+            if current_weight + weight <= limit:
+                current_mean += (mean - current_mean) * weight / (current_weight + weight)
+                current_weight += weight
+            else:
+                merged_means.append(current_mean)
+                merged_weights.append(current_weight)
+                cumulative += current_weight
+                current_mean, current_weight = mean, weight
+        merged_means.append(current_mean)
+        merged_weights.append(current_weight)
+
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    def quantile(self, q, minimum, maximum):
+        if not len(self.means):
+            return None
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0.0], centers, [self.count]])
+        values = np.concatenate([[minimum], self.means, [maximum]])
+        return float(np.interp(q * self.count, positions, values))
+
+    def cdf(self, x, minimum, maximum):
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0.0], centers, [self.count]])
+        values = np.concatenate([[minimum], self.means, [maximum]])
+        return np.interp(x, values, positions)
+
+    def to_dict(self):
+        return {'compression': self.compression, 'means': self.means.tolist(), 'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['compression'], data['means'], data['weights'])
+
+
+class TopK:
+    """
+    Misra-Gries heavy hitters. Counts are exact while the column has at most
+    `capacity` distinct values and lower bounds otherwise.
+    """
+
+    def __init__(self, capacity=100, counts=None):
+        self.capacity = capacity
+        self.counts = dict(counts or {})
+
+    def update(self, series):
+        self._add(series.value_counts(dropna=True).items())
+
+    def merge(self, other):
+        self._add(other.counts.items())
+
+    def _add(self, items):
+        for value, count in items:
+            key = str(value)
+            self.counts[key] = self.counts.get(key, 0) + int(count)
+        if len(self.counts) > self.capacity:
+            threshold = sorted(self.counts.values(), reverse=True)[self.capacity]
+            self.counts = {k: c - threshold for k, c in self.counts.items() if c > threshold}
+
+    def top(self, k=TOP_K):
+        return [{'value': value, 'count': count}
+                for value, count in sorted(self.counts.items(), key=lambda item: -item[1])[:k]]
+
+    def to_dict(self):
+        return {'capacity': self.capacity, 'counts': self.counts}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['capacity'], data['counts'])
+
+
+class ColumnProfile:
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.count = 0
+        self.nulls = 0
+        self.minimum = None
+        self.maximum = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.distinct = HyperLogLog()
+        self.quantiles = QuantileSketch() if kind in NUMERIC_TYPES else None
+        self.value_counts = {} if kind in NUMERIC_TYPES else None
+        self.top_k = TopK() if kind not in ('float', 'date') else None
+
+    def update(self, series):
+        nulls = int(series.isna().sum())
+        values = series.dropna()
+        self.count += len(series)
+        self.nulls += nulls
+        if values.empty:
+            return
+
+        self.distinct.update(values)
+        if self.top_k is not None:
+            self.top_k.update(values)
+
+        if self.kind in NUMERIC_TYPES:
+            array = values.to_numpy(dtype=np.float64)
+            self._merge_moments(len(array), float(array.mean()), float(((array - array.mean()) ** 2).sum()))
+            self.quantiles.update(array)
+            self._merge_range(float(array.min()), float(array.max()))
+            if self.value_counts is not None:
+                keys, counts = np.unique(array, return_counts=True)
+                self._merge_value_counts(zip(keys.tolist(), counts.tolist()))
+        elif self.kind == 'date':
+            self._merge_range(min(values), max(values))
+
+    def widen(self, kind):
+        # Counts and distinct registers carry over; numeric and date summaries no longer apply to text
+        self.kind = kind
+        if kind in NUMERIC_TYPES:
+            return
+        self.minimum = self.maximum = None
+        self.mean = self.m2 = 0.0
+        self.quantiles = None
+        self.value_counts = None
+        if self.top_k is None:
+            self.top_k = TopK()
+
+    def _merge_moments(self, count, mean, m2):
+        # Chan et al. parallel update of mean and sum of squared deviations
+        existing = self.count - self.nulls - count
+        total = existing + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * existing * count / total
+
+    def _merge_value_counts(self, items):
+        for value, count in items:
+            self.value_counts[value] = self.value_counts.get(value, 0) + count
+        if len(self.value_counts) > EXACT_VALUES:
+            self.value_counts = None
+
+    def _merge_range(self, minimum, maximum):
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    def merge(self, other):
+        if other.count - other.nulls:
+            self.count += other.count
+            self.nulls += other.nulls
+            self._merge_moments(other.count - other.nulls, other.mean, other.m2)
+        else:
+            self.count += other.count
+            self.nulls += other.nulls
+        if other.minimum is not None:
+            self._merge_range(other.minimum, other.maximum)
+        self.distinct.merge(other.distinct)
+        if self.quantiles is not None:
+            self.quantiles.merge(other.quantiles)
+        if self.value_counts is not None:
+            if other.value_counts is None:
+                self.value_counts = None
+            else:
+                self._merge_value_counts(other.value_counts.items())
+        if self.top_k is not None:
+            self.top_k.merge(other.top_k)
+
+    def summary(self):
+        non_null = self.count - self.nulls
+        summary = {
+            'type': self.kind,
+            'count': self.count,
+            'null_count': self.nulls,
+            'approx_distinct': min(self.distinct.estimate(), non_null),
+        }
+        if self.kind in NUMERIC_TYPES and non_null:
+            summary.update({
+                'min': self.minimum,
+                'max': self.maximum,
+                'mean': self.mean,
+                'std': math.sqrt(self.m2 / (non_null - 1)) if non_null > 1 else 0.0,
+                'quantiles': {str(q): self.quantiles.quantile(q, self.minimum, self.maximum) for q in QUANTILES},
+                'histogram': self._histogram(),
+            })
+        elif self.kind == 'date' and non_null:
+            summary.update({'min': str(self.minimum), 'max': str(self.maximum)})
+        if self.top_k is not None:
+            summary['top_values'] = self.top_k.top()
+        return summary
+
+    def _histogram(self):
+        edges = np.linspace(self.minimum, self.maximum, HISTOGRAM_BINS + 1)
+        if self.value_counts is not None:
+            # Few distinct values, e.g. years or months, are binned exactly
+            counts, _ = np.histogram(list(self.value_counts), bins=edges, weights=list(self.value_counts.values()))
+            return {'edges': edges.tolist(), 'counts': counts.astype(int).tolist()}
+        # Otherwise bin counts are read off the sketch CDF, so merged sketches give merged histograms
+        cumulative = self.quantiles.cdf(edges, self.minimum, self.maximum)
+        counts = np.diff(np.round(cumulative)).astype(int)
+        return {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+    def to_dict(self):
+        return {
+            'name': self.name, 'kind': self.kind, 'count': self.count, 'nulls': self.nulls,
+            'minimum': None if self.minimum is None else str(self.minimum) if self.kind == 'date' else self.minimum,
+            'maximum': None if self.maximum is None else str(self.maximum) if self.kind == 'date' else self.maximum,
+            'mean': self.mean, 'm2': self.m2,
+            'distinct': self.distinct.to_dict(),
+            'quantiles': self.quantiles.to_dict() if self.quantiles is not None else None,
+            'value_counts': list(self.value_counts.items()) if self.value_counts is not None else None,
+            'top_k': self.top_k.to_dict() if self.top_k is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        profile = cls(data['name'], data['kind'])
+        profile.count, profile.nulls = data['count'], data['nulls']
+        profile.minimum, profile.maximum = data['minimum'], data['maximum']
+        if profile.kind == 'date' and profile.minimum is not None:
+            profile.minimum = datetime.date.fromisoformat(profile.minimum)
+            profile.maximum = datetime.date.fromisoformat(profile.maximum)
+        profile.mean, profile.m2 = data['mean'], data['m2']
+        profile.distinct = HyperLogLog.from_dict(data['distinct'])
+        if data['quantiles'] is not None:
+            profile.quantiles = QuantileSketch.from_dict(data['quantiles'])
+        profile.value_counts = dict(data['value_counts']) if data.get('value_counts') is not None else None
+        if data['top_k'] is not None:
+            profile.top_k = TopK.from_dict(data['top_k'])
+        return profile
+
+
+class DatasetProfiler:
+    """
+    Single-pass per-column profile. Feed it chunks with update(); partial
+    profilers from other chunks or workers combine with merge().
+    """
+
+    def __init__(self, schema):
+        self.columns = {column['name']: ColumnProfile(column['name'], column['type']) for column in schema}
+
+    def update(self, chunk):
+        for name, profile in self.columns.items():
+            if name in chunk:
+                profile.update(chunk[name])
+
+    def merge(self, other):
+        for name, profile in other.columns.items():
+            if name in self.columns:
+                self.columns[name].merge(profile)
+            else:
+                self.columns[name] = profile
+
+    def summary(self):
+        return {name: profile.summary() for name, profile in self.columns.items()}
+
+    def to_dict(self):
+        return [profile.to_dict() for profile in self.columns.values()]
+
+    @classmethod
+    def from_dict(cls, data):
+        profiler = cls([])
+        profiler.columns = {column['name']: ColumnProfile.from_dict(column) for column in data}
+        return profiler
@@ -0,0 +1,51 @@
+SAMPLE_STRATA = ['brand', 'year']
+Z_95 = 1.96
+
+
+def sample_table(dataset_id):
+    return f"sample_data_{dataset_id}"
+
+
+def approx_sum_sql(table, groups, measures, where_clause='1=1', order_by=None):
+    """
+    Stratified estimates of SUM(measure) per group from sample_data_{id}.
+
+    groups: list of (sql expression, alias); measures: {column: output name}.
+    Each stratum h contributes N_h / n_h * sum(y) to the estimate and
+    N_h^2 (1 - n_h / N_h) s_h^2 / n_h to its variance, where y is the measure
+    inside the filtered group and zero elsewhere in the stratum. Returns the
+    estimate with a 95% confidence interval.
+    """
+    group_select = ', '.join(f"{expr} AS {alias}" for expr, alias in groups)
+    aliases = ', '.join(alias for _, alias in groups)
+
+    sums = ', '.join(f"SUM({column}) AS sy_{i}, SUM({column} * {column}) AS sq_{i}"
+                     for i, column in enumerate(measures))
+    estimates = []
+    for i, name in enumerate(measures.values()):
+        variance = (
+            f"CASE WHEN sampled > 1 THEN GREATEST(stratum_total * stratum_total * (1 - sampled / stratum_total) "
+            f"* (sq_{i} - sy_{i} * sy_{i} / sampled) / (sampled - 1) / sampled, 0) "
+            f"ELSE 0 END"
+        )
+        estimate = f"SUM(stratum_total / sampled * sy_{i})"
+        margin = f"{Z_95} * SQRT(SUM({variance}))"
+        estimates.append(
+            f"ROUND({estimate}::numeric, 2) AS {name}, "
+            f"ROUND(({estimate} - {margin})::numeric, 2) AS {name}_ci_low, "
+            f"ROUND(({estimate} + {margin})::numeric, 2) AS {name}_ci_high"
+        )
+
+    return f"""
+    SELECT {aliases}, {', '.join(estimates)}
+    FROM (
+        SELECT {group_select}, {sums},
+               MAX(stratum_rows)::double precision AS stratum_total,
+               MAX(stratum_sample)::double precision AS sampled
+        FROM {table}
+        WHERE {where_clause}
+        GROUP BY {', '.join(str(i + 1) for i in range(len(groups)))}, stratum_id
+    ) per_stratum
+    GROUP BY {aliases}
+    ORDER BY {order_by or aliases}
+    """
@@ -0,0 +1,116 @@
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .ingest import detect_format
+
+MB = 1024 * 1024
+
+
+def estimate_ingest_bytes(dataset):
+    # Compressed and columnar uploads expand several times over once parsed
+    try:
+        size = dataset.original_file.size
+        with open(dataset.original_file.path, 'rb') as f:
+            head = f.read(4)
+    except (OSError, ValueError):
+        return 0
+    if detect_format(head) != 'csv':
+        size *= settings.INGEST_COMPRESSION_FACTOR
+    return size
+
+
+def ingest_queue(size):
+    for queue, max_bytes in settings.INGEST_QUEUES:
+        if max_bytes is None or size <= max_bytes:
+            return queue
+    return settings.INGEST_QUEUES[-1][0]
+
+
+def ingest_priority(size):
+    # Redis serves priority 0 first; each tenfold increase above 1 MB drops one step
+    return min(9, max(0, math.ceil(math.log10(max(size, 1) / MB))))
+
+
+def ingest_route(dataset):
+    size = estimate_ingest_bytes(dataset)
+    return {'queue': ingest_queue(size), 'priority': ingest_priority(size)}
+
+
+def _lock_key(dataset_id):
+    return f"ingest:lock:{dataset_id}"
+
+
+def acquire_dataset_lock(dataset_id, token):
+    """
+    Claim a dataset for ingestion. Only one token holds the lock until it is
+    released, so a double-submit cannot queue or run the same dataset twice.
+    """
+    if cache.add(_lock_key(dataset_id), token, settings.INGEST_LOCK_TIMEOUT):
+        return True
+    return cache.get(_lock_key(dataset_id)) == token
+
+
+def release_dataset_lock(dataset_id, token):
+    if cache.get(_lock_key(dataset_id)) == token:
+        cache.delete(_lock_key(dataset_id))
+
+
+def _user_key(user_id):
+    return f"ingest:user:{user_id}:running"
+
+
+def _heartbeat_key(dataset_id):
+    return f"ingest:heartbeat:{dataset_id}"
+
+
+class IngestionHeartbeat(threading.Thread):
+    """
+    Keeps a running ingestion's heartbeat alive. If the worker dies the key
+    expires on its own, so the user's slot frees up without a release.
+    """
+
+    def __init__(self, dataset_id):
+        super().__init__(daemon=True)
+        self.dataset_id = dataset_id
+        self.stopped = threading.Event()
+
+    def beat(self):
+        cache.set(_heartbeat_key(self.dataset_id), 1, settings.INGEST_HEARTBEAT_TIMEOUT)
+
+    def run(self):
+        while not self.stopped.wait(settings.INGEST_HEARTBEAT_TIMEOUT / 3):
+            self.beat()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        cache.delete(_heartbeat_key(self.dataset_id))
+
+
+def acquire_user_slot(user_id, dataset_id):
+    """
+    Caps how many ingestions one user runs at once so others are not starved.
+    Returns a started heartbeat for the slot, or None when the user is at the
+    limit. Only datasets with a live heartbeat count as running.
+    """
+    admit_key = f"ingest:user:{user_id}:admit"
+    if not cache.add(admit_key, 1, settings.INGEST_ADMIT_TIMEOUT):
+        return None
+    try:
+        running = [other for other in cache.get(_user_key(user_id), []) if other != dataset_id]
+        alive = cache.get_many([_heartbeat_key(other) for other in running])
+        running = [other for other in running if _heartbeat_key(other) in alive]
+        if len(running) >= settings.INGEST_MAX_CONCURRENT_PER_USER:
+            cache.set(_user_key(user_id), running, settings.INGEST_LOCK_TIMEOUT)
+            return None
+
+        heartbeat = IngestionHeartbeat(dataset_id)
+        heartbeat.beat()
+        cache.set(_user_key(user_id), running + [dataset_id], settings.INGEST_LOCK_TIMEOUT)
+    finally:
+        cache.delete(admit_key)
+    heartbeat.start()
+    return heartbeat
@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+from .ingest import iter_dataframes, open_dataset_source
+from .models import Dataset
+
+SAMPLE_ROWS = 20000
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+DATE_FORMATS = ['%Y-%m-%d', '%d-%m-%Y', '%m-%d-%Y', '%d/%m/%Y', '%m/%d/%Y', '%Y/%m/%d']
+# Timestamps are only stored as dates when every time is midnight
+DATETIME_FORMATS = [f'{fmt}{sep}%H:%M:%S' for fmt in DATE_FORMATS for sep in (' ', 'T')]
+
+INTEGER_RANGES = [
+    ('smallint', np.iinfo(np.int16)),
+    ('integer', np.iinfo(np.int32)),
+    ('bigint', np.iinfo(np.int64)),
+]
+
+PG_TYPES = {
+    'category': 'text',
+    'text': 'text',
+    'date': 'date',
+    'smallint': 'smallint',
+    'integer': 'integer',
+    'bigint': 'bigint',
+    'float': 'double precision',
+}
+
+# Numeric columns are left to pandas so a stray non-numeric value reads as object and widens the column
+READ_DTYPES = {
+    'category': 'category',
+    'text': 'object',
+    'date': 'object',
+}
+
+PANDAS_INTEGER_DTYPES = {'smallint': 'Int16', 'integer': 'Int32', 'bigint': 'Int64'}
+
+NUMERIC_TYPES = {'smallint', 'integer', 'bigint', 'float'}
+
+# Measures feed every aggregate, so they stay numeric and unparseable cells become nulls
+MEASURE_COLUMNS = {'salesvalue', 'volume'}
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def clean_column_names(columns):
+    return columns.astype(str).str.strip().str.lower().str.replace(' ', '_')
+
+
+def _integer_type(values):
+    if values.empty:
+        return 'smallint'
+    if (values % 1 != 0).any():
+        return 'float'
+    for kind, limits in INTEGER_RANGES:
+        if values.min() >= limits.min and values.max() <= limits.max:
+            return kind
+    return 'float'
+
+
+def parse_dates(values, fmt):
+    # NaT wherever a value does not match the format, including non-midnight times
+    parsed = pd.to_datetime(values, format=fmt, errors='coerce')
+    if '%H' in fmt:
+        parsed = parsed.where(parsed == parsed.dt.normalize())
+    return parsed
+
+
+def _date_format(values):
+    for fmt in DATE_FORMATS + DATETIME_FORMATS:
+        if parse_dates(values, fmt).notna().all():
+            return fmt
+    return None
+
+
+def infer_column(name, source, series):
+    column = {'name': name, 'source': source}
+    values = series.dropna()
+
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        column['type'] = _integer_type(values.astype('float64'))
+        return column
+
+    values = values.astype(str)
+    date_format = _date_format(values) if not values.empty else None
+    if date_format:
+        column['type'] = 'date'
+        column['format'] = date_format
+    elif values.empty or values.nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(values):
+        column['type'] = 'category'
+    else:
+        column['type'] = 'text'
+    return column
+
+
+def infer_schema(sample):
+    names = clean_column_names(sample.columns)
+    return [infer_column(name, source, sample[source]) for name, source in zip(names, sample.columns)]
+
+
+def _accepts(stored, inferred):
+    # Whether a stored column can hold everything the new sample inferred for it
+    if stored['source'] != inferred['source']:
+        return False
+    if stored['type'] in ('category', 'text'):
+        return True
+    if stored['type'] == 'date':
+        return inferred['type'] == 'date' and inferred['format'] == stored['format']
+    if stored['type'] == 'float':
+        return inferred['type'] in NUMERIC_TYPES
+    if inferred['type'] in PANDAS_INTEGER_DTYPES:
+        return not _wider(inferred['type'], stored['type'])
+    return False
+
+
+def find_project_schema(dataset, sample_schema):
+    # Later uploads to the same project reuse the schema when it fits their own sample
+    previous = (
+        Dataset.objects
+        .filter(project=dataset.project, status__in=Dataset.READY_STATUSES, inferred_schema__isnull=False)
+        .exclude(id=dataset.id)
+        .order_by('-created_at')
+        .values_list('inferred_schema', flat=True)
+    )
+    for schema in previous:
+        if len(schema) == len(sample_schema) and all(map(_accepts, schema, sample_schema)):
+            return schema
+    return None
+
+
+def resolve_schema(dataset):
+    with open_dataset_source(dataset) as stream:
+        sample = next(iter_dataframes(dataset, stream, chunk_rows=SAMPLE_ROWS), None)
+    if sample is None:
+        raise ValueError('Dataset file is empty')
+
+    inferred = infer_schema(sample)
+    schema = find_project_schema(dataset, inferred)
+    if schema:
+        print(f"@ done -  [CELERY] Reusing schema from project {dataset.project_id}")
+        return schema
+
+    print(f"@ done -  [CELERY] Inferred schema from {len(sample)} sampled rows")
+    return inferred
+
+
+def read_dtypes(schema):
+    return {column['source']: READ_DTYPES[column['type']] for column in schema if column['type'] in READ_DTYPES}
+
+
+def create_table_sql(table_name, schema):
+    columns = ', '.join(f"{quote_identifier(column['name'])} {PG_TYPES[column['type']]}" for column in schema)
+    return f"CREATE TABLE {table_name} ({columns})"
+
+
+def _as_text(series):
+    return series.astype(object).where(series.isna(), series.astype(str))
+
+
+def _widen_to_text(chunk, column, original, failures):
+    print(f">>>>  {failures} values in {column['name']} do not parse as {column['type']}, storing it as text")
+    column['type'] = 'text'
+    column.pop('format', None)
+    chunk[column['name']] = _as_text(original)
+
+
+def coerce_chunk(chunk, schema, dropped=None):
+    """
+    Convert a chunk to the schema types in place. Returns the columns whose
+    type had to be widened because the chunk did not fit the sampled type;
+    values that do not parse at all widen the column to text, except in
+    measure columns, where they are nulled and counted in dropped.
+    """
+    widened = []
+    for column in schema:
+        name, kind = column['name'], column['type']
+        if name not in chunk:
+            continue
+        original = chunk[name]
+
+        if kind == 'date':
+            parsed = parse_dates(original, column['format'])
+            failures = int((parsed.isna() & original.notna()).sum())
+            if failures:
+                _widen_to_text(chunk, column, original, failures)
+                widened.append(column)
+            else:
+                chunk[name] = parsed.dt.date
+        elif kind in NUMERIC_TYPES:
+            values = pd.to_numeric(original, errors='coerce').astype('float64')
+            failures = int((values.isna() & original.notna()).sum())
+            if failures and name in MEASURE_COLUMNS:
+                if dropped is not None:
+                    dropped[name] = dropped.get(name, 0) + failures
+            elif failures:
+                _widen_to_text(chunk, column, original, failures)
+                widened.append(column)
+                continue
+            if kind in PANDAS_INTEGER_DTYPES:
+                fitted = _integer_type(values.dropna())
+                if fitted == 'float' or _wider(fitted, kind):
+                    column['type'] = kind = fitted
+                    widened.append(column)
+            chunk[name] = values if kind == 'float' else values.astype(PANDAS_INTEGER_DTYPES[kind])
+        else:
+            chunk[name] = _as_text(original)
+    return widened
+
+
+def _wider(kind, than):
+    order = [name for name, _ in INTEGER_RANGES]
+    return order.index(kind) > order.index(than)
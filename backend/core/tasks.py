@@ -1,54 +1,111 @@
 import os
-import pandas as pd
+import time
+import uuid
+from datetime import timedelta
 from celery import shared_task
 from django.conf import settings
+from django.utils import timezone
 from sqlalchemy import create_engine, text
-from .models import Dataset
+from .models import Dataset, UploadSession
+from .correlation import build_matrix, correlation_sql, numeric_columns
+from .ingest import iter_dataframes, open_dataset_source
+from .profiling import DatasetProfiler
+from .sampling import SAMPLE_STRATA, sample_table
+from .scheduling import (
+    acquire_dataset_lock, acquire_user_slot, ingest_route, release_dataset_lock
+)
+from .uploads import abort_upload, delete_upload_file
+from .trends import TREND_DIMENSIONS, TREND_GRANULARITIES, trend_table, trend_total_table
+from .schema import (
+    NUMERIC_TYPES, PG_TYPES, clean_column_names, coerce_chunk, create_table_sql,
+    quote_identifier, read_dtypes, resolve_schema
+)
 
-@shared_task(bind=True)
-def process_and_store_data(self, dataset_id):
+
+def get_engine():
+    db_config = settings.DATABASES['default']
+    connection_string = f"postgresql://{db_config['USER']}:{db_config['PASSWORD']}@{db_config['HOST']}:{db_config['PORT']}/{db_config['NAME']}"
+    return create_engine(connection_string)
+
+
+def enqueue_ingestion(dataset):
+    """
+    Queue a dataset for ingestion on the queue that matches its size, with
+    smaller uploads prioritised. Returns None when it is already queued.
+    """
+    token = uuid.uuid4().hex
+    if not acquire_dataset_lock(dataset.id, token):
+        print(f">>>> Dataset {dataset.id} is already queued for ingestion, ignoring duplicate submit")
+        return None
+
+    route = ingest_route(dataset)
+    print(f"@ done -  [API] Queued dataset {dataset.id} on {route['queue']} (priority {route['priority']})")
+    try:
+        return process_and_store_data.apply_async(args=[dataset.id], kwargs={'lock_token': token}, **route)
+    except Exception:
+        release_dataset_lock(dataset.id, token)
+        raise
+
+
+@shared_task(bind=True, max_retries=None)
+def process_and_store_data(self, dataset_id, lock_token=None):
     print(f"\n@ done - [CELERY] Starting processing for dataset_id: {dataset_id}")
     
-    dataset = Dataset.objects.get(id=dataset_id)
+    dataset = Dataset.objects.select_related('project').get(id=dataset_id)
+    
+    lock_token = lock_token or self.request.id
+    if not acquire_dataset_lock(dataset_id, lock_token):
+        print(f">>>> Dataset {dataset_id} is already being processed, dropping duplicate task")
+        return f"Dataset {dataset_id} skipped"
+    
+    # A redelivered task can arrive after the original finished and released the lock
+    dataset.refresh_from_db(fields=['status'])
+    if dataset.status in Dataset.READY_STATUSES:
+        print(f">>>> Dataset {dataset_id} is already {dataset.status}, skipping redelivered task")
+        release_dataset_lock(dataset_id, lock_token)
+        return f"Dataset {dataset_id} skipped"
+    
+    owner_id = dataset.project.owner_id
+    heartbeat = acquire_user_slot(owner_id, dataset_id)
+    if heartbeat is None:
+        # Back of the queue, so other users' uploads run while this user is at their limit
+        print(f">>>> User {owner_id} is at the ingestion limit, requeueing dataset {dataset_id}")
+        raise self.retry(countdown=settings.INGEST_USER_RETRY_SECONDS, **ingest_route(dataset))
     
     try:
         dataset.status = 'processing'
-        dataset.save(update_fields=['status'])
+        dataset.processing_started_at = timezone.now()
+        dataset.processing_completed_at = None
+        dataset.file_size_bytes = dataset.original_file.size
+        dataset.save(update_fields=['status', 'processing_started_at', 'processing_completed_at',
+                                    'file_size_bytes', *dataset.mark_data_changed()])
         
-        # Load CSV
-        file_path = dataset.original_file.path
-        df = pd.read_csv(file_path)
-        print(f"@ done -  [CELERY] Loaded {len(df)} rows from {os.path.basename(file_path)}")
-        
-        # Cleaning column names
-        df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+        engine = get_engine()
+        raw_table_name = f"raw_data_{dataset_id}"
         
-        # remove rows with all nulls
-        for col in df.columns:
-            if df[col].dtype in ['float64', 'int64']:
-                df[col].fillna(df[col].median(), inplace=True)
-            else:
-                df[col].fillna('Unknown', inplace=True)
+        # Sample the file once so the full read and the table use explicit narrow types
+        schema = resolve_schema(dataset)
+        columns = [column['name'] for column in schema]
         
-        # removing duplicates
-        initial_rows = len(df)
-        df.drop_duplicates(inplace=True)
-        print(f"@ done -  [CELERY] Removed {initial_rows - len(df)} duplicate rows")
+        # Load chunk by chunk so memory is bounded by the chunk size, not the file size
+        loaded_rows, null_numeric_columns, profiler, unparsed = load_raw_table(engine, dataset, raw_table_name, schema)
+        print(f"@ done -  [CELERY] Loaded {loaded_rows} rows from {os.path.basename(dataset.original_file.name)}")
+        for col, count in unparsed.items():
+            print(f">>>>  {count} values in {col} did not parse as numbers and were stored as nulls")
         
-        # laoding to psql
-        db_config = settings.DATABASES['default']
-        connection_string = f"postgresql://{db_config['USER']}:{db_config['PASSWORD']}@{db_config['HOST']}:{db_config['PORT']}/{db_config['NAME']}"
-        engine = create_engine(connection_string)
+        # Median needs the whole column, so numeric nulls are filled once everything is loaded
+        fill_numeric_nulls(engine, raw_table_name, null_numeric_columns)
         
-        raw_table_name = f"raw_data_{dataset_id}"
-        df.to_sql(raw_table_name, engine, if_exists='replace', index=False, method='multi', chunksize=5000)
+        # removing duplicates
+        total_rows = drop_duplicate_rows(engine, raw_table_name)
+        print(f"@ done -  [CELERY] Removed {loaded_rows - total_rows} duplicate rows")
         print(f"@ done -  [CELERY] Raw data stored in table '{raw_table_name}'")
         
         # Create indexes
         with engine.connect() as conn:
             index_columns = ['brand', 'packtype', 'ppg', 'channel', 'year', 'month', 'date']
             for col in index_columns:
-                if col in df.columns:
+                if col in columns:
                     try:
                         conn.execute(text(f'CREATE INDEX IF NOT EXISTS idx_{raw_table_name}_{col} ON {raw_table_name} ({col})'))
                         conn.commit()
@@ -58,23 +115,188 @@ def process_and_store_data(self, dataset_id):
         print(f"@ done -  [CELERY] Indexes created")
         
         # Create aggregation tables
-        create_aggregation_tables(engine, dataset_id, raw_table_name, df.columns.tolist())
+        create_aggregation_tables(engine, dataset_id, raw_table_name, columns)
+        create_trend_rollups(engine, dataset_id, raw_table_name, schema)
+        create_stratified_sample(engine, dataset_id, raw_table_name, columns)
         
-        dataset.status = 'completed'
+        # Warm the common dashboard views before reporting the dataset as completed
+        dataset.status = 'warming' if settings.CACHE_WARMING_ENABLED else 'completed'
         dataset.error_message = None
-        dataset.save(update_fields=['status', 'error_message'])
+        dataset.total_rows = total_rows
+        dataset.inferred_schema = schema
+        dataset.correlation_matrix = compute_correlation(engine, raw_table_name, schema)
+        dataset.data_profile = {
+            'row_count': loaded_rows,
+            'unparsed_values': unparsed,
+            'columns': profiler.summary(),
+            'sketches': profiler.to_dict(),
+        }
+        dataset.processing_completed_at = timezone.now()
+        dataset.date_range_start, dataset.date_range_end = get_date_range(engine, raw_table_name, schema)
+        dataset.save(update_fields=['status', 'error_message', 'total_rows', 'inferred_schema',
+                                    'correlation_matrix', 'data_profile', 'processing_completed_at',
+                                    'date_range_start', 'date_range_end', *dataset.mark_data_changed()])
         print(f"@ done -  [CELERY] Dataset {dataset_id} completed successfully!")
         
+        if dataset.status == 'warming':
+            warm_dataset_cache.delay(dataset_id)
+        
     except Exception as e:
         print(f"~~X Error [CELERY ERROR] {str(e)}")
         dataset.status = 'failed'
         dataset.error_message = str(e)
-        dataset.save(update_fields=['status', 'error_message'])
+        dataset.save(update_fields=['status', 'error_message', *dataset.mark_data_changed()])
         raise e
     
+    finally:
+        heartbeat.stop()
+        release_dataset_lock(dataset_id, lock_token)
+    
     return f"Dataset {dataset_id} processed"
 
 
+@shared_task(bind=True)
+def warm_dataset_cache(self, dataset_id):
+    # Imported here because the API views import this module
+    from .api.views import AnalyticsView, get_filter_values
+    
+    dataset = Dataset.objects.get(id=dataset_id)
+    if dataset.status != 'warming':
+        return f"Dataset {dataset_id} not warming"
+    
+    deadline = time.monotonic() + settings.CACHE_WARMING_TIME_BUDGET
+    analytics = AnalyticsView()
+    warmed = 0
+    
+    try:
+        get_filter_values(dataset)
+        analytics.build_analytics(dataset)
+        warmed += 2
+        
+        for dimension, value in top_dimension_values(dataset):
+            if time.monotonic() > deadline:
+                print(f">>>>  [CELERY] Warm-up time budget exhausted after {warmed} views")
+                break
+            analytics.build_analytics(dataset, **{dimension: value})
+            warmed += 1
+    except Exception as e:
+        print(f">>>>  [CELERY] Warm-up stopped early: {e}")
+    finally:
+        # Warm-up only speeds up first loads, so the dataset is completed either way
+        Dataset.objects.filter(id=dataset_id, status='warming').update(status='completed')
+    
+    print(f"@ done -  [CELERY] Warmed {warmed} views for dataset {dataset_id}")
+    return f"Dataset {dataset_id} warmed"
+
+
+@shared_task
+def expire_upload_sessions():
+    # Abandoned uploads would otherwise keep their pre-sized files on disk forever
+    cutoff = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+    stale = UploadSession.objects.select_related('dataset').filter(status='active', updated_at__lt=cutoff)
+    
+    expired = 0
+    for session in stale:
+        # Well past the stream idle timeout, so no ingestion is still reading the file
+        if abort_upload(session, 'Upload expired'):
+            delete_upload_file(session)
+            expired += 1
+    
+    print(f"@ done -  [CELERY] Expired {expired} stale upload sessions")
+    return f"Expired {expired} upload sessions"
+
+
+def top_dimension_values(dataset):
+    # Most frequent values per dimension, straight from the ingestion profile
+    profile = (dataset.data_profile or {}).get('columns', {})
+    keywords = {'brand': 'brand', 'packtype': 'pack_type', 'ppg': 'ppg', 'channel': 'channel', 'year': 'year'}
+    for dimension in settings.CACHE_WARMING_DIMENSIONS:
+        top_values = profile.get(dimension, {}).get('top_values', [])
+        for item in top_values[:settings.CACHE_WARMING_TOP_N]:
+            yield keywords[dimension], item['value']
+
+
+def load_raw_table(engine, dataset, raw_table_name, schema):
+    loaded_rows = 0
+    null_numeric_columns = set()
+    unparsed = {}
+    profiler = DatasetProfiler(schema)
+    
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {raw_table_name}"))
+        conn.execute(text(create_table_sql(raw_table_name, schema)))
+    
+    with open_dataset_source(dataset) as stream:
+        for chunk in iter_dataframes(dataset, stream, dtype=read_dtypes(schema)):
+            chunk.columns = clean_column_names(chunk.columns)
+            
+            # Widen columns whose sampled type does not fit the rest of the file
+            for column in coerce_chunk(chunk, schema, unparsed):
+                name, pg_type = quote_identifier(column['name']), PG_TYPES[column['type']]
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        f"ALTER TABLE {raw_table_name} ALTER COLUMN {name} TYPE {pg_type} USING {name}::{pg_type}"
+                    ))
+                if column['type'] not in NUMERIC_TYPES:
+                    null_numeric_columns.discard(column['name'])
+                profiler.columns[column['name']].widen(column['type'])
+                print(f">>>>  Widened {column['name']} to {column['type']}")
+            
+            # Profile the values as uploaded, before nulls are filled
+            profiler.update(chunk)
+            
+            for column in schema:
+                col = column['name']
+                if column['type'] in NUMERIC_TYPES:
+                    if chunk[col].isna().any():
+                        null_numeric_columns.add(col)
+                elif column['type'] != 'date':
+                    chunk[col] = chunk[col].fillna('Unknown')
+            
+            chunk.to_sql(raw_table_name, engine, if_exists='append', index=False, method='multi', chunksize=5000)
+            loaded_rows += len(chunk)
+    
+    return loaded_rows, null_numeric_columns, profiler, unparsed
+
+
+def get_date_range(engine, raw_table_name, schema):
+    if not any(column['name'] == 'date' and column['type'] == 'date' for column in schema):
+        return None, None
+    with engine.connect() as conn:
+        return tuple(conn.execute(text(f"SELECT MIN(date), MAX(date) FROM {raw_table_name}")).one())
+
+
+def fill_numeric_nulls(engine, raw_table_name, columns):
+    with engine.begin() as conn:
+        for col in columns:
+            column = quote_identifier(col)
+            conn.execute(text(f"""
+                UPDATE {raw_table_name}
+                SET {column} = (SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY {column}) FROM {raw_table_name})
+                WHERE {column} IS NULL
+            """))
+
+
+def drop_duplicate_rows(engine, raw_table_name):
+    dedup_table = f"{raw_table_name}_dedup"
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {dedup_table}"))
+        conn.execute(text(f"CREATE TABLE {dedup_table} AS SELECT DISTINCT * FROM {raw_table_name}"))
+        conn.execute(text(f"DROP TABLE {raw_table_name}"))
+        conn.execute(text(f"ALTER TABLE {dedup_table} RENAME TO {raw_table_name}"))
+        return conn.execute(text(f"SELECT COUNT(*) FROM {raw_table_name}")).scalar()
+
+
+def compute_correlation(engine, raw_table_name, schema):
+    columns = numeric_columns(schema)
+    if len(columns) < 2:
+        return None
+    with engine.connect() as conn:
+        row = conn.execute(text(correlation_sql(raw_table_name, columns))).one()
+    print(f"@ done -  [CELERY] Correlation matrix computed for {len(columns)} columns")
+    return build_matrix(columns, row)
+
+
 def create_aggregation_tables(engine, dataset_id, raw_table_name, columns):
     print(f"@ done -  [CELERY] Creating aggregation tables...")
     
@@ -110,3 +332,87 @@ def create_aggregation_tables(engine, dataset_id, raw_table_name, columns):
                 print(f">>>>  Skipped {agg_table}: {e}")
     
     print(f"@ done -  [CELERY] All aggregation tables created")
+
+
+def create_trend_rollups(engine, dataset_id, raw_table_name, schema):
+    types = {column['name']: column['type'] for column in schema}
+    rollup_table = trend_table(dataset_id)
+    total_table = trend_total_table(dataset_id)
+    
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {rollup_table}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {total_table}"))
+    
+    if types.get('date') != 'date' or types.get('salesvalue') not in NUMERIC_TYPES:
+        print(f">>>>  Skipped {rollup_table}: no typed date or numeric salesvalue column")
+        return
+    
+    dimensions = ', '.join(d for d in TREND_DIMENSIONS if d in types)
+    group_dimensions = f", {dimensions}" if dimensions else ''
+    
+    try:
+        with engine.begin() as conn:
+            # Daily level from the raw table, coarser levels from the daily rollup
+            conn.execute(text(f"""
+                CREATE TABLE {rollup_table} AS
+                SELECT 'day'::text AS granularity, date AS period{group_dimensions},
+                       SUM(salesvalue) AS total_sales
+                FROM {raw_table_name}
+                WHERE date IS NOT NULL
+                GROUP BY date{group_dimensions}
+            """))
+            for granularity in TREND_GRANULARITIES[1:]:
+                conn.execute(text(f"""
+                    INSERT INTO {rollup_table}
+                    SELECT '{granularity}', date_trunc('{granularity}', period)::date{group_dimensions},
+                           SUM(total_sales)
+                    FROM {rollup_table}
+                    WHERE granularity = 'day'
+                    GROUP BY date_trunc('{granularity}', period){group_dimensions}
+                """))
+            conn.execute(text(f"CREATE INDEX idx_{rollup_table}_period ON {rollup_table} (granularity, period)"))
+            
+            # The dimensional levels are close to the raw grain, so unfiltered trends read this instead
+            conn.execute(text(f"""
+                CREATE TABLE {total_table} AS
+                SELECT granularity, period, SUM(total_sales) AS total_sales
+                FROM {rollup_table}
+                GROUP BY granularity, period
+            """))
+            conn.execute(text(f"ALTER TABLE {total_table} ADD PRIMARY KEY (granularity, period)"))
+    except Exception as e:
+        print(f">>>>  Skipped {rollup_table}: {e}")
+        return
+    
+    print(f"@ done -  Created: {rollup_table}, {total_table}")
+
+
+def create_stratified_sample(engine, dataset_id, raw_table_name, columns):
+    # Fixed-fraction random sample per brand/year stratum for approximate answers
+    table = sample_table(dataset_id)
+    strata = ', '.join(c for c in SAMPLE_STRATA if c in columns)
+    partition = f"PARTITION BY {strata}" if strata else ''
+    stratum_id = f"dense_rank() OVER (ORDER BY {strata})" if strata else '1'
+    column_list = ', '.join(quote_identifier(c) for c in columns)
+    
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        conn.execute(text(f"""
+            CREATE TABLE {table} AS
+            SELECT {column_list}, stratum_id, stratum_rows, stratum_sample
+            FROM (
+                SELECT {column_list},
+                       {stratum_id} AS stratum_id,
+                       row_number() OVER ({partition} ORDER BY random()) AS sample_rank,
+                       COUNT(*) OVER ({partition}) AS stratum_rows
+                FROM {raw_table_name}
+            ) ranked
+            CROSS JOIN LATERAL (
+                SELECT LEAST(stratum_rows, GREATEST({settings.APPROX_SAMPLE_MIN_ROWS},
+                       CEIL(stratum_rows * {settings.APPROX_SAMPLE_FRACTION})))::bigint AS stratum_sample
+            ) sized
+            WHERE sample_rank <= stratum_sample
+        """))
+        sampled = conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+    
+    print(f"@ done -  Created: {table} ({sampled} rows)")
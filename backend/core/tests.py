@@ -1,3 +1,872 @@
-from django.test import TestCase
+import bz2
+import datetime
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import zstandard
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+from sqlalchemy import URL, create_engine, text
+
+from core.api.shapes import shape_analytics, to_pivot
+from core.api.views import AnalyticsView, BatchAnalyticsView
+from core.correlation import build_matrix, subset_matrix
+from core.ingest import detect_format, iter_dataframes
+from core.models import Dataset, Project, UploadSession
+from core.profiling import DatasetProfiler
+from core.sampling import sample_table
+from core.scheduling import _heartbeat_key, acquire_dataset_lock, acquire_user_slot
+from core.schema import coerce_chunk, find_project_schema, infer_schema
+from core.tasks import (
+    create_stratified_sample, expire_upload_sessions, process_and_store_data, warm_dataset_cache
+)
+from core.trends import lttb
+
+
+class QueryBudgetMixin:
+    """
+    Fails when a block runs more queries than its budget. The budget is
+    fixed, so a list endpoint that goes N+1 breaks as soon as it has rows.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        executed = len(context.captured_queries)
+        if executed > budget:
+            queries = '\n'.join(query['sql'] for query in context.captured_queries)
+            self.fail(f'{executed} queries executed, budget is {budget}:\n{queries}')
+
+
+class ListQueryBudgetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='password123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_projects(self, projects, datasets_per_project):
+        for p in range(projects):
+            project = Project.objects.create(name=f'project {p}', owner=self.user)
+            for d in range(datasets_per_project):
+                Dataset.objects.create(project=project, name=f'dataset {p}.{d}', original_file='datasets/test.csv')
+
+    def test_project_list_is_constant(self):
+        self.create_projects(projects=10, datasets_per_project=3)
+
+        with self.assertQueryBudget(2):
+            response = self.client.get('/api/projects/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertTrue(all(project['dataset_count'] == 3 for project in response.data['results']))
+        self.assertTrue(all(len(project['datasets']) == 3 for project in response.data['results']))
+
+    def test_project_retrieve(self):
+        self.create_projects(projects=1, datasets_per_project=5)
+        project = Project.objects.get()
+
+        with self.assertQueryBudget(2):
+            response = self.client.get(f'/api/projects/{project.id}/')
+
+        self.assertEqual(response.data['dataset_count'], 5)
+
+    def test_dataset_list_is_constant(self):
+        self.create_projects(projects=4, datasets_per_project=5)
+
+        with self.assertQueryBudget(1):
+            response = self.client.get('/api/datasets/', {'page_size': 10})
+
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_dataset_cursor_walks_every_row_once(self):
+        self.create_projects(projects=2, datasets_per_project=7)
+
+        seen = []
+        url = '/api/datasets/?page_size=5'
+        while url:
+            response = self.client.get(url)
+            seen.extend(dataset['id'] for dataset in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(sorted(seen), sorted(Dataset.objects.values_list('id', flat=True)))
+
+
+class UploadRetryTests(TestCase):
+    PART_SIZE = 1024 * 1024
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='uploader', password='password123')
+        self.project = Project.objects.create(name='uploads', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.payload = bytes(range(256)) * (self.PART_SIZE // 256) + b'tail of the upload'
+
+    def initiate(self, stream_ingest=False):
+        response = self.client.post('/api/uploads/', {
+            'project': self.project.id,
+            'filename': 'sales.csv',
+            'total_size': len(self.payload),
+            'part_size': self.PART_SIZE,
+            'stream_ingest': stream_ingest,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['upload_id']
+
+    def put_part(self, upload_id, number, body, checksum=None):
+        headers = {'HTTP_X_CHECKSUM_SHA256': checksum} if checksum else {}
+        return self.client.put(f'/api/uploads/{upload_id}/parts/{number}/', body,
+                               content_type='application/octet-stream', **headers)
+
+    def part(self, number):
+        return self.payload[(number - 1) * self.PART_SIZE:number * self.PART_SIZE]
+
+    def stored_bytes(self):
+        with open(Dataset.objects.get().original_file.path, 'rb') as f:
+            return f.read()
+
+    def test_failed_retry_keeps_acknowledged_part(self):
+        upload_id = self.initiate()
+        for number in (1, 2):
+            self.assertEqual(self.put_part(upload_id, number, self.part(number)).status_code, 200)
+
+        corrupted = b'x' * len(self.part(2))
+        response = self.put_part(upload_id, 2, corrupted, hashlib.sha256(self.part(2)).hexdigest())
+        self.assertEqual(response.status_code, 400)
+        response = self.put_part(upload_id, 2, self.part(2)[:-1])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_bytes(), self.payload)
+
+        response = self.client.post(f'/api/uploads/{upload_id}/complete/', {}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored_bytes(), self.payload)
+
+    def test_verified_retry_replaces_part(self):
+        upload_id = self.initiate()
+        self.put_part(upload_id, 1, b'y' * self.PART_SIZE)
+        response = self.put_part(upload_id, 1, self.part(1), hashlib.sha256(self.part(1)).hexdigest())
+        self.assertEqual(response.status_code, 200)
+        self.put_part(upload_id, 2, self.part(2))
+
+        self.assertEqual(self.stored_bytes(), self.payload)
+        self.assertEqual(self.client.post(f'/api/uploads/{upload_id}/complete/', {}, format='json').status_code, 200)
+
+    def test_streaming_upload_rejects_changed_part(self):
+        upload_id = self.initiate(stream_ingest=True)
+        self.put_part(upload_id, 1, self.part(1))
+
+        response = self.put_part(upload_id, 1, b'z' * self.PART_SIZE)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_bytes()[:self.PART_SIZE], self.part(1))
+
+    @override_settings(UPLOAD_MAX_SIZE=1024 * 1024)
+    def test_oversized_upload_is_rejected(self):
+        response = self.client.post('/api/uploads/', {
+            'project': self.project.id, 'filename': 'huge.csv', 'total_size': 1024 * 1024 + 1,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('total_size', response.json())
+        self.assertFalse(Dataset.objects.exists())
+
+    def test_stale_sessions_expire(self):
+        stale_id, fresh_id = self.initiate(), self.initiate()
+        self.put_part(stale_id, 1, self.part(1))
+        UploadSession.objects.filter(id=stale_id).update(
+            updated_at=timezone.now() - datetime.timedelta(seconds=settings.UPLOAD_SESSION_TTL + 60)
+        )
+        stale = UploadSession.objects.select_related('dataset').get(id=stale_id)
+        path = stale.dataset.original_file.path
+
+        self.assertEqual(expire_upload_sessions.apply().get(), 'Expired 1 upload sessions')
+        stale.refresh_from_db()
+        stale.dataset.refresh_from_db()
+        self.assertEqual(stale.status, 'aborted')
+        self.assertEqual((stale.dataset.status, stale.dataset.error_message), ('failed', 'Upload expired'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.put_part(stale_id, 2, self.part(2)).status_code, 409)
+
+        fresh = UploadSession.objects.get(id=fresh_id)
+        self.assertEqual(fresh.status, 'active')
+        self.assertTrue(os.path.exists(fresh.dataset.original_file.path))
+
+        # Aborting by hand goes through the same path
+        self.assertEqual(self.client.delete(f'/api/uploads/{fresh_id}/').status_code, 204)
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, 'aborted')
+        self.assertFalse(os.path.exists(fresh.dataset.original_file.path))
+
+
+class IngestFormatTests(TestCase):
+    FRAME = pd.DataFrame({'Brand': ['A', 'B', 'C'] * 50, 'Year': range(2000, 2150), 'SalesValue': np.arange(150) * 1.5})
+
+    def csv_bytes(self):
+        return self.FRAME.to_csv(index=False).encode()
+
+    def read(self, data, dataset=None, chunk_rows=40):
+        stream = io.BufferedReader(io.BytesIO(data))
+        return pd.concat(iter_dataframes(dataset, stream, chunk_rows=chunk_rows), ignore_index=True)
+
+    def compressed(self):
+        data = self.csv_bytes()
+        return {'gzip': gzip.compress(data), 'bz2': bz2.compress(data),
+                'zstd': zstandard.ZstdCompressor().compress(data)}
+
+    def test_detect_format(self):
+        for fmt, data in self.compressed().items():
+            self.assertEqual(detect_format(data[:4]), fmt)
+        self.assertEqual(detect_format(b'PAR1'), 'parquet')
+        self.assertEqual(detect_format(self.csv_bytes()[:4]), 'csv')
+        # Heads shorter than any magic number are plain text
+        self.assertEqual(detect_format(b'\x1f'), 'csv')
+        self.assertEqual(detect_format(b''), 'csv')
+
+    def test_compressed_csv_matches_plain(self):
+        plain = self.read(self.csv_bytes())
+        pd.testing.assert_frame_equal(plain, self.FRAME)
+        for fmt, data in self.compressed().items():
+            pd.testing.assert_frame_equal(self.read(data), plain, obj=fmt)
+
+    def test_chunks_are_bounded(self):
+        stream = io.BufferedReader(io.BytesIO(self.compressed()['gzip']))
+        self.assertEqual([len(chunk) for chunk in iter_dataframes(None, stream, chunk_rows=40)], [40, 40, 40, 30])
+
+    def test_parquet(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        user = User.objects.create_user(username='parquet', password='password123')
+        project = Project.objects.create(name='parquet', owner=user)
+        with override_settings(MEDIA_ROOT=media_root):
+            dataset = Dataset.objects.create(project=project, name='parquet', original_file='sales.parquet')
+            self.FRAME.to_parquet(dataset.original_file.path, row_group_size=40)
+            with open(dataset.original_file.path, 'rb') as stream:
+                frame = self.read(stream.read(), dataset)
+        pd.testing.assert_frame_equal(frame, self.FRAME)
+
+    def test_short_and_truncated_streams(self):
+        self.assertEqual(len(self.read(b'Brand\n')), 0)
+        with self.assertRaises(pd.errors.EmptyDataError):
+            self.read(b'')
+        for fmt in ('gzip', 'bz2'):
+            data = self.compressed()[fmt]
+            with self.assertRaises(EOFError, msg=fmt):
+                self.read(data[:len(data) // 2])
+
+
+class SchemaCoercionTests(TestCase):
+    def sampled_schema(self):
+        return infer_schema(pd.DataFrame({
+            'Date': ['2020-01-05', '2020-01-06'],
+            'SalesValue': [10.5, 20.0],
+            'Volume': [3, 4],
+        }))
+
+    def test_unparseable_values_widen_to_text(self):
+        schema = self.sampled_schema()
+        chunk = pd.DataFrame({'date': ['2020-01-07', '05/01/2020'], 'salesvalue': ['1.5', '2.5'], 'volume': [5, 6]})
+
+        widened = coerce_chunk(chunk, schema)
+
+        self.assertEqual([column['name'] for column in widened], ['date'])
+        self.assertEqual([column['type'] for column in schema], ['text', 'float', 'smallint'])
+        self.assertEqual(list(chunk['date']), ['2020-01-07', '05/01/2020'])
+
+    def test_unparseable_measures_are_nulled_and_counted(self):
+        schema = self.sampled_schema()
+        chunk = pd.DataFrame({'date': ['2020-01-07', '2020-01-08'], 'salesvalue': ['1.5', 'n/a'], 'volume': ['x', 6]})
+        dropped = {}
+
+        widened = coerce_chunk(chunk, schema, dropped)
+
+        self.assertEqual(widened, [])
+        self.assertEqual([column['type'] for column in schema], ['date', 'float', 'smallint'])
+        self.assertEqual(dropped, {'salesvalue': 1, 'volume': 1})
+        self.assertEqual(chunk['salesvalue'].iloc[0], 1.5)
+        self.assertTrue(chunk['salesvalue'].isna().iloc[1])
+        self.assertTrue(chunk['volume'].isna().iloc[0])
+        self.assertEqual(chunk['volume'].iloc[1], 6)
+
+    def test_midnight_timestamps_are_dates(self):
+        schema = infer_schema(pd.DataFrame({
+            'day': ['2020-01-05 00:00:00', '2020-01-06 00:00:00'],
+            'moment': ['2020-01-05 10:30:00', '2020-01-06 00:00:00'],
+        }))
+        self.assertEqual([column['type'] for column in schema], ['date', 'text'])
+
+    def test_project_schema_is_reused_only_when_it_fits_the_sample(self):
+        user = User.objects.create_user(username='schema', password='password123')
+        project = Project.objects.create(name='schemas', owner=user)
+        Dataset.objects.create(project=project, name='first', original_file='datasets/a.csv',
+                               status='completed', inferred_schema=self.sampled_schema())
+        upload = Dataset.objects.create(project=project, name='second', original_file='datasets/b.csv')
+
+        same = self.sampled_schema()
+        self.assertEqual(find_project_schema(upload, same), same)
+        other_format = infer_schema(pd.DataFrame({
+            'Date': ['05/01/2020', '25/01/2020'], 'SalesValue': [1.0, 2.0], 'Volume': [1, 2],
+        }))
+        self.assertIsNone(find_project_schema(upload, other_format))
+
+
+@override_settings(INGEST_MAX_CONCURRENT_PER_USER=2)
+class UserSlotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_limit_and_release(self):
+        first, second = acquire_user_slot(1, 10), acquire_user_slot(1, 11)
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(acquire_user_slot(1, 12))
+        other_user = acquire_user_slot(2, 20)
+        self.assertIsNotNone(other_user)
+        other_user.stop()
+
+        first.stop()
+        third = acquire_user_slot(1, 12)
+        self.assertIsNotNone(third)
+        second.stop()
+        third.stop()
+
+    def test_crashed_worker_frees_its_slot(self):
+        crashed = acquire_user_slot(1, 10)
+        running = acquire_user_slot(1, 11)
+        self.assertIsNone(acquire_user_slot(1, 12))
+
+        # A killed worker never calls stop(); its heartbeat just expires
+        crashed.stopped.set()
+        crashed.join()
+        cache.delete(_heartbeat_key(10))
+
+        replacement = acquire_user_slot(1, 12)
+        self.assertIsNotNone(replacement)
+        running.stop()
+        replacement.stop()
+
+
+class RedeliveryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_completed_dataset_is_not_reprocessed(self):
+        user = User.objects.create_user(username='redelivery', password='password123')
+        project = Project.objects.create(name='redelivery', owner=user)
+        dataset = Dataset.objects.create(project=project, name='done', original_file='datasets/done.csv',
+                                         status='completed')
+
+        result = process_and_store_data.apply(args=[dataset.id], kwargs={'lock_token': 'token'}).get()
+
+        self.assertEqual(result, f'Dataset {dataset.id} skipped')
+        self.assertTrue(acquire_dataset_lock(dataset.id, 'another token'))
+
+
+class ProfilerMergeTests(SimpleTestCase):
+    SCHEMA = [{'name': 'sales', 'type': 'float'}, {'name': 'brand', 'type': 'category'}]
+
+    def frame(self):
+        rng = np.random.default_rng(7)
+        sales = rng.normal(100, 15, 5000)
+        sales[::50] = np.nan
+        return pd.DataFrame({'sales': sales, 'brand': rng.choice(['A', 'B', 'C', 'D'], 5000)})
+
+    def test_merged_chunks_match_single_pass(self):
+        frame = self.frame()
+        single = DatasetProfiler(self.SCHEMA)
+        single.update(frame)
+
+        merged = DatasetProfiler(self.SCHEMA)
+        for start in range(0, len(frame), 700):
+            part = DatasetProfiler(self.SCHEMA)
+            part.update(frame.iloc[start:start + 700])
+            # Partial profiles travel between workers as dicts
+            merged.merge(DatasetProfiler.from_dict(part.to_dict()))
+
+        expected, actual = single.summary(), merged.summary()
+        for key in ('count', 'null_count', 'min', 'max'):
+            self.assertEqual(actual['sales'][key], expected['sales'][key])
+        self.assertAlmostEqual(actual['sales']['mean'], expected['sales']['mean'], places=9)
+        self.assertAlmostEqual(actual['sales']['std'], expected['sales']['std'], places=9)
+        self.assertEqual(actual['brand']['top_values'], expected['brand']['top_values'])
+
+    def test_sketches_track_the_data(self):
+        frame = self.frame()
+        profiler = DatasetProfiler(self.SCHEMA)
+        profiler.update(frame)
+        summary = profiler.summary()
+
+        values = frame['sales'].dropna()
+        self.assertEqual(summary['sales']['null_count'], 100)
+        self.assertAlmostEqual(summary['sales']['std'], values.std(), places=9)
+        self.assertAlmostEqual(summary['sales']['quantiles']['0.5'], values.median(), delta=1.0)
+        self.assertEqual(summary['brand']['approx_distinct'], 4)
+        self.assertEqual(sum(bin_count for bin_count in summary['sales']['histogram']['counts']), len(values))
+
+    def test_integer_histogram_is_exact(self):
+        rng = np.random.default_rng(11)
+        frame = pd.DataFrame({'year': rng.integers(2018, 2024, 3000), 'month': rng.integers(1, 13, 3000)})
+        schema = [{'name': 'year', 'type': 'smallint'}, {'name': 'month', 'type': 'smallint'}]
+
+        merged = DatasetProfiler(schema)
+        for start in range(0, len(frame), 700):
+            part = DatasetProfiler(schema)
+            part.update(frame.iloc[start:start + 700])
+            merged.merge(DatasetProfiler.from_dict(part.to_dict()))
+
+        for name, histogram in ((name, column['histogram']) for name, column in merged.summary().items()):
+            expected, edges = np.histogram(frame[name], bins=len(histogram['counts']))
+            self.assertEqual(histogram['counts'], expected.tolist())
+            np.testing.assert_allclose(histogram['edges'], edges)
+
+
+class LttbTests(SimpleTestCase):
+    def rows(self, count):
+        start = datetime.date(2020, 1, 1)
+        return [{'date': start + datetime.timedelta(days=i), 'total_sales': float((i * 37) % 101)}
+                for i in range(count)]
+
+    def test_keeps_endpoints_and_point_count(self):
+        rows = self.rows(500)
+        sampled = lttb(rows, 50)
+
+        self.assertEqual(len(sampled), 50)
+        self.assertEqual(sampled[0], rows[0])
+        self.assertEqual(sampled[-1], rows[-1])
+        self.assertEqual([row['date'] for row in sampled], sorted(row['date'] for row in sampled))
+
+    def test_short_series_is_untouched(self):
+        rows = self.rows(20)
+        self.assertEqual(lttb(rows, 50), rows)
+
+
+class ShapeTests(SimpleTestCase):
+    def test_pivot_layout(self):
+        rows = [
+            {'brand': 'B', 'year': 2021, 'total_sales': Decimal('3.5')},
+            {'brand': 'A', 'year': 2020, 'total_sales': Decimal('1.0')},
+            {'brand': 'B', 'year': 2020, 'total_sales': Decimal('2.0')},
+        ]
+        self.assertEqual(to_pivot(rows, 'total_sales'), {
+            'brand': ['B', 'A'],
+            'year': [2020, 2021],
+            'total_sales': [[2.0, 3.5], [1.0, None]],
+        })
+
+    def test_columns_shape(self):
+        shaped = shape_analytics({'market_share': [{'brand': 'A', 'total_sales': Decimal('1.5')}],
+                                  'dataset_id': 3}, 'columns')
+        self.assertEqual(shaped, {'market_share': {'brand': ['A'], 'total_sales': [1.5]},
+                                  'dataset_id': 3, 'shape': 'columns'})
+
+
+class FilterValidationTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='filters', password='password123')
+        project = Project.objects.create(name='filters', owner=user)
+        self.dataset = Dataset.objects.create(
+            project=project, name='typed', original_file='datasets/typed.csv', status='completed',
+            inferred_schema=[{'name': 'ppg', 'source': 'PPG', 'type': 'smallint'},
+                             {'name': 'year', 'source': 'Year', 'type': 'smallint'},
+                             {'name': 'salesvalue', 'source': 'SalesValue', 'type': 'float'}],
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_bad_typed_filters_are_rejected(self):
+        for endpoint in ('correlation', 'export'):
+            for query in ('year=abc', 'year=2020.5', 'ppg=large'):
+                response = self.client.get(f'/api/datasets/{self.dataset.id}/{endpoint}/?{query}')
+                self.assertEqual(response.status_code, 400, f'{endpoint}?{query}')
+                self.assertIn('must be an integer', response.json()['error'])
+
+        response = self.client.post(f'/api/datasets/{self.dataset.id}/analytics/batch/',
+                                    {'filters': [{'year': 2020}, {'year': 'abc'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHE_WARMING_DIMENSIONS=['brand', 'year'], CACHE_WARMING_TOP_N=2)
+class CacheWarmingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='warming', password='password123')
+        project = Project.objects.create(name='warming', owner=user)
+        self.dataset = Dataset.objects.create(
+            project=project, name='warming', original_file='datasets/w.csv', status='warming',
+            data_profile={'row_count': 6, 'columns': {
+                'brand': {'top_values': [{'value': 'A', 'count': 3}, {'value': 'B', 'count': 2},
+                                         {'value': 'C', 'count': 1}]},
+                'year': {'top_values': [{'value': '2021', 'count': 4}]},
+            }},
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE raw_data_{self.dataset.id} (brand text, packtype text, ppg text, "
+                           f"channel text, year integer)")
+            cursor.execute(f"INSERT INTO raw_data_{self.dataset.id} VALUES ('A', 'Can', 'P1', 'X', 2021)")
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+        # The section queries are Postgres SQL; only whether they run matters here
+        for name, value in (('_table_exists', False), ('_execute_query', [])):
+            patcher = mock.patch.object(AnalyticsView, name, return_value=value)
+            setattr(self, name.strip('_'), patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_warm_up_fills_cache_then_completes(self):
+        # Warming datasets already serve requests
+        self.assertEqual(self.client.get(f'/api/datasets/{self.dataset.id}/analytics/').status_code, 200)
+        cache.clear()
+        self.execute_query.reset_mock()
+
+        self.assertEqual(warm_dataset_cache.apply(args=[self.dataset.id]).get(), f'Dataset {self.dataset.id} warmed')
+        self.dataset.refresh_from_db()
+        self.assertEqual(self.dataset.status, 'completed')
+
+        warmed_queries = self.execute_query.call_count
+        # Unfiltered, the two most frequent brands and the top year: five sections each
+        self.assertEqual(warmed_queries, 4 * 5)
+        for query in ('', '?brand=A', '?brand=B', '?year=2021'):
+            response = self.client.get(f'/api/datasets/{self.dataset.id}/analytics/{query}')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.execute_query.call_count, warmed_queries)
+        self.client.get(f'/api/datasets/{self.dataset.id}/analytics/?brand=C')
+        self.assertGreater(self.execute_query.call_count, warmed_queries)
+
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(f'/api/datasets/{self.dataset.id}/filters/')
+        self.assertFalse(any('raw_data' in query['sql'] for query in context.captured_queries))
+
+    def test_failed_warm_up_still_completes(self):
+        self.execute_query.side_effect = RuntimeError('database went away')
+        warm_dataset_cache.apply(args=[self.dataset.id]).get()
+        self.dataset.refresh_from_db()
+        self.assertEqual(self.dataset.status, 'completed')
+
+        self.assertEqual(warm_dataset_cache.apply(args=[self.dataset.id]).get(),
+                         f'Dataset {self.dataset.id} not warming')
+
+
+class ConditionalRequestTests(TestCase):
+    ANALYTICS = {'dataset_info': {'id': 0, 'name': 'conditional'}, 'market_share': [{'brand': 'A', 'total_sales': 1.0}]}
+
+    def setUp(self):
+        user = User.objects.create_user(username='conditional', password='password123')
+        project = Project.objects.create(name='conditional', owner=user)
+        self.dataset = Dataset.objects.create(project=project, name='conditional', original_file='datasets/c.csv',
+                                              status='completed')
+        self.dataset.mark_data_changed()
+        self.dataset.save()
+        self.url = f'/api/datasets/{self.dataset.id}/analytics/'
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+        patcher = mock.patch.object(AnalyticsView, 'build_analytics', return_value=self.ANALYTICS)
+        self.build_analytics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_validators_and_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag, modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(modified, http_date(int(self.dataset.data_updated_at.timestamp())))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 304)
+        # A 304 is decided before any data is built
+        self.assertEqual(self.build_analytics.call_count, 1)
+
+    def test_validators_change_with_query_and_version(self):
+        etag = self.client.get(self.url)['ETag']
+        filtered = self.client.get(self.url, {'brand': 'A'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(filtered.status_code, 200)
+        self.assertNotEqual(filtered['ETag'], etag)
+
+        self.dataset.mark_data_changed()
+        self.dataset.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'raw dataset tables need Postgres')
+class BatchAnalyticsTests(TestCase):
+    FILTERS = [
+        {},
+        {'brand': 'A'},
+        {'brand': 'C'},
+        {'year': 2021},
+        {'brand': 'B', 'channel': 'X'},
+        {'packType': 'Can', 'year': '2020'},
+        {'brand': 'missing'},
+    ]
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='batch', password='password123')
+        project = Project.objects.create(name='batch', owner=user)
+        self.dataset = Dataset.objects.create(
+            project=project, name='batch', original_file='datasets/batch.csv', status='completed',
+            inferred_schema=[{'name': name, 'source': name, 'type': kind} for name, kind in [
+                ('brand', 'category'), ('packtype', 'category'), ('ppg', 'category'), ('channel', 'category'),
+                ('year', 'smallint'), ('month', 'smallint'), ('date', 'date'),
+                ('salesvalue', 'float'), ('volume', 'float'),
+            ]],
+        )
+        rows = [
+            (brand, pack, 'P1', channel, year, month, datetime.date(year, month, 1 + i % 20), 10 + i * 3.1, 900 - i * 2.3)
+            for i, (brand, pack, channel, year, month) in enumerate(
+                itertools.product('ABC', ['Can', 'Bottle'], 'XY', [2020, 2021], [1, 2, 3]))
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TABLE raw_data_{self.dataset.id} (
+                    brand text, packtype text, ppg text, channel text, year smallint, month smallint,
+                    date date, salesvalue double precision, volume double precision
+                )
+            """)
+            cursor.executemany(f"INSERT INTO raw_data_{self.dataset.id} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", rows)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_batch_matches_single_requests(self):
+        response = self.client.post(f'/api/datasets/{self.dataset.id}/analytics/batch/',
+                                    {'filters': self.FILTERS}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['X-Batch-Size'], str(len(self.FILTERS)))
+
+        body = b''.join(response.streaming_content).decode()
+        self.assertTrue(body.endswith('\n'))
+        lines = [json.loads(line) for line in body.split('\n')[:-1]]
+        sections = BatchAnalyticsView.SECTIONS
+        self.assertEqual([(line['section'], line['index']) for line in lines],
+                         [(section, index) for section in sections for index in range(len(self.FILTERS))])
+
+        batch = {(line['index'], line['section']): line['data'] for line in lines}
+        for index, filters in enumerate(self.FILTERS):
+            single = self.client.get(f'/api/datasets/{self.dataset.id}/analytics/', filters).json()
+            for section in sections:
+                self.assertEqual(batch[index, section], single[section], f'{section} for {filters}')
+        self.assertEqual(batch[6, 'sales_by_brand_year'], [])
+        self.assertTrue(batch[0, 'monthly_trend'])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'raw dataset tables need Postgres')
+class TopBrandsTests(TestCase):
+    # A real brand called "Other" must stay apart from the long-tail bucket
+    SALES = {'Other': 500, 'A': 300, 'B': 100, 'C': 60, 'D': 40}
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='top', password='password123')
+        project = Project.objects.create(name='top', owner=user)
+        self.dataset = Dataset.objects.create(project=project, name='top', original_file='datasets/top.csv',
+                                              status='completed')
+        rows = [(brand, year, sales / 2, 1.0) for brand, sales in self.SALES.items() for year in (2020, 2021)]
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE raw_data_{self.dataset.id} (brand text, packtype text, ppg text, "
+                           f"channel text, year smallint, month smallint, date date, salesvalue double precision, "
+                           f"volume double precision)")
+            cursor.executemany(f"INSERT INTO raw_data_{self.dataset.id} (brand, year, salesvalue, volume) "
+                               f"VALUES (%s, %s, %s, %s)", rows)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def get(self, **params):
+        return self.client.get(f'/api/datasets/{self.dataset.id}/analytics/', params).json()
+
+    def test_top_n_folds_the_tail_into_other(self):
+        response = self.get(top_n=2)
+        self.assertEqual(
+            [(row['brand'], row['is_other'], row['total_sales']) for row in response['market_share']],
+            [('Other', False, 500), ('A', False, 300), ('Other', True, 200)],
+        )
+        self.assertEqual(sum(row['sales_share_pct'] for row in response['market_share']), 100)
+        self.assertEqual(
+            [(row['brand'], row['is_other'], row['total_sales']) for row in response['sales_by_brand_year']
+             if row['year'] == 2020],
+            [('Other', False, 250), ('A', False, 150), ('Other', True, 100)],
+        )
+
+        pivot = self.get(top_n=2, shape='pivot')['sales_by_brand_year']
+        self.assertEqual(pivot['brand'], ['Other', 'A', 'Other'])
+        self.assertEqual(pivot['is_other'], [False, False, True])
+        self.assertEqual(pivot['total_sales'], [[250, 250], [150, 150], [100, 100]])
+
+    def test_min_share_keeps_large_brands(self):
+        # B has exactly 10% of sales, C and D fall below it
+        market_share = self.get(min_share=10)['market_share']
+        self.assertEqual([(row['brand'], row['is_other']) for row in market_share],
+                         [('Other', False), ('A', False), ('B', False), ('Other', True)])
+        self.assertEqual(market_share[-1]['total_sales'], 100)
+
+
+def database_engine():
+    # SQLAlchemy engine on the Django test database, for the ingestion helpers
+    db = connection.settings_dict
+    return create_engine(URL.create('postgresql+psycopg2', username=db['USER'], password=db['PASSWORD'] or None,
+                                    host=db['HOST'] or None, port=db['PORT'] or None, database=db['NAME']))
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'the sample is built with Postgres SQL')
+@override_settings(APPROX_SAMPLE_FRACTION=0.1, APPROX_SAMPLE_MIN_ROWS=50)
+class StratifiedSampleTests(TransactionTestCase):
+    COLUMNS = ['brand', 'year', 'date', 'salesvalue', 'volume']
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='sample', password='password123')
+        project = Project.objects.create(name='sample', owner=user)
+        self.dataset = Dataset.objects.create(project=project, name='sample', original_file='datasets/s.csv',
+                                              status='completed')
+        self.engine = database_engine()
+        self.addCleanup(self.engine.dispose)
+
+        rng = np.random.default_rng(3)
+        strata = {
+            ('A', 2020): np.full(400, 5.0),
+            ('A', 2021): rng.normal(100, 20, 400),
+            # Smaller than the minimum sample, so it is taken whole
+            ('B', 2020): rng.uniform(0, 10, 30),
+            ('B', 2021): rng.uniform(0, 50, 400),
+        }
+        self.frame = pd.DataFrame([
+            {'brand': brand, 'year': year, 'date': datetime.date(year, 1 + i % 12, 1), 'salesvalue': value,
+             'volume': 1.0}
+            for (brand, year), values in strata.items() for i, value in enumerate(values)
+        ])
+        self.raw_table = f'raw_data_{self.dataset.id}'
+        self.frame.to_sql(self.raw_table, self.engine, index=False)
+        self.addCleanup(self.drop_tables)
+
+    def drop_tables(self):
+        with self.engine.begin() as conn:
+            conn.execute(text(f'DROP TABLE IF EXISTS {self.raw_table}, {sample_table(self.dataset.id)}'))
+
+    def test_sample_sizes_and_intervals(self):
+        create_stratified_sample(self.engine, self.dataset.id, self.raw_table, self.COLUMNS)
+        with self.engine.connect() as conn:
+            sizes = conn.execute(text(
+                f'SELECT brand, year, COUNT(*), MAX(stratum_rows), MAX(stratum_sample) '
+                f'FROM {sample_table(self.dataset.id)} GROUP BY brand, year ORDER BY brand, year'
+            )).all()
+        self.assertEqual([tuple(row) for row in sizes],
+                         [('A', 2020, 50, 400, 50), ('A', 2021, 50, 400, 50),
+                          ('B', 2020, 30, 30, 30), ('B', 2021, 50, 400, 50)])
+
+        user = User.objects.get(username='sample')
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(f'/api/datasets/{self.dataset.id}/analytics/', {'approx': '1'}).json()
+        self.assertTrue(response['approximate'])
+
+        exact = self.frame.groupby(['brand', 'year'])['salesvalue'].sum()
+        for row in response['sales_by_brand_year']:
+            truth, estimate = exact[row['brand'], row['year']], row['total_sales']
+            low, high = row['total_sales_ci_low'], row['total_sales_ci_high']
+            self.assertLessEqual(low, estimate)
+            self.assertLessEqual(estimate, high)
+            if (row['brand'], row['year']) in (('A', 2020), ('B', 2020)):
+                # Constant values and fully sampled strata are estimated exactly
+                self.assertAlmostEqual(estimate, truth, places=1)
+                self.assertEqual(low, high)
+            else:
+                self.assertGreater(high, low)
+                # Twice the 95% margin, so a miss is a bug rather than bad luck
+                self.assertLess(abs(estimate - truth), high - low)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'exports stream through Postgres COPY')
+class ExportTests(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='export', password='password123')
+        project = Project.objects.create(name='export', owner=user)
+        self.dataset = Dataset.objects.create(
+            project=project, name='export', original_file='datasets/e.csv', status='completed',
+            inferred_schema=[{'name': 'brand', 'source': 'Brand', 'type': 'category'},
+                             {'name': 'year', 'source': 'Year', 'type': 'smallint'},
+                             {'name': 'salesvalue', 'source': 'SalesValue', 'type': 'float'}],
+        )
+        self.rows = [('A' if i % 3 else 'B, Ltd', 2020 + i % 2, i * 0.5) for i in range(5000)]
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE raw_data_{self.dataset.id} (brand text, year smallint, "
+                           f"salesvalue double precision)")
+            cursor.executemany(f"INSERT INTO raw_data_{self.dataset.id} VALUES (%s, %s, %s)", self.rows)
+        self.addCleanup(self.drop_table)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def drop_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS raw_data_{self.dataset.id}")
+
+    def export(self, **params):
+        response = self.client.get(f'/api/datasets/{self.dataset.id}/export/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def frame(self, rows):
+        return pd.DataFrame(rows, columns=['brand', 'year', 'salesvalue'])
+
+    @override_settings(EXPORT_CHUNK_BYTES=4096, EXPORT_QUEUE_BLOCKS=2)
+    def test_csv_export(self):
+        response, body = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn(f'dataset_{self.dataset.id}.csv', response['Content-Disposition'])
+        pd.testing.assert_frame_equal(pd.read_csv(io.BytesIO(body)), self.frame(self.rows))
+
+        response, body = self.export(compression='gzip', brand='A', year='2021')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        expected = self.frame([row for row in self.rows if row[0] == 'A' and row[1] == 2021]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(pd.read_csv(io.BytesIO(gzip.decompress(body))), expected)
+
+    @override_settings(EXPORT_PARQUET_ROW_GROUP=1000)
+    def test_parquet_export(self):
+        response, body = self.export(output='parquet')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.parquet')
+        parquet_file = pq.ParquetFile(io.BytesIO(body))
+        self.assertEqual(parquet_file.metadata.num_row_groups, 5)
+        self.assertEqual(str(parquet_file.schema_arrow.field('year').type), 'int16')
+        pd.testing.assert_frame_equal(parquet_file.read().to_pandas(), self.frame(self.rows), check_dtype=False)
+
+
+class CorrelationMatrixTests(SimpleTestCase):
+    def test_build_and_subset(self):
+        # COUNT(*) then corr() for (a,b), (a,c), (b,c)
+        result = build_matrix(['a', 'b', 'c'], (10, 0.5, float('nan'), -0.25))
+        self.assertEqual(result['matrix'], [[1.0, 0.5, None], [0.5, 1.0, -0.25], [None, -0.25, 1.0]])
+
+        subset = subset_matrix(result, ['c', 'b'])
+        self.assertEqual(subset, {'columns': ['c', 'b'], 'row_count': 10, 'matrix': [[1.0, -0.25], [-0.25, 1.0]]})
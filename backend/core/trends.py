@@ -0,0 +1,62 @@
+import datetime
+import math
+
+import numpy as np
+
+TREND_GRANULARITIES = ['day', 'week', 'month', 'quarter', 'year']
+TREND_DIMENSIONS = ['brand', 'packtype', 'ppg', 'channel', 'year']
+
+
+def trend_table(dataset_id):
+    return f"agg_trend_{dataset_id}"
+
+
+def trend_total_table(dataset_id):
+    # One row per (granularity, period) for unfiltered trends
+    return f"agg_trend_total_{dataset_id}"
+
+
+def _x_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, datetime.date):
+        return float(value.toordinal())
+    return float(value)
+
+
+def lttb(rows, max_points, x_key='date', y_key='total_sales'):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Keeps the first and last row
+    and, from each bucket in between, the row forming the largest triangle
+    with the previous pick and the next bucket's average, preserving the
+    peaks and troughs a line chart needs.
+    """
+    count = len(rows)
+    if max_points >= count or max_points < 3:
+        return rows
+
+    x = np.array([_x_value(row[x_key]) for row in rows])
+    y = np.array([float(row[y_key] or 0) for row in rows])
+
+    every = (count - 2) / (max_points - 2)
+    selected = [0]
+    previous = 0
+    for i in range(max_points - 2):
+        start = int(math.floor(i * every)) + 1
+        end = int(math.floor((i + 1) * every)) + 1
+        next_start = end
+        next_end = min(int(math.floor((i + 2) * every)) + 1, count)
+        if next_start >= next_end:
+            next_start, next_end = count - 1, count
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+
+        areas = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected.append(previous)
+    selected.append(count - 1)
+
+    return [rows[i] for i in selected]
@@ -0,0 +1,154 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import UploadSession
+
+
+class UploadError(Exception):
+    pass
+
+
+def reserve_upload_file(filename, total_size):
+    # Pre-size the target file so parts can be written at their offsets in any order
+    name = default_storage.get_available_name(os.path.join(settings.UPLOAD_DIR, os.path.basename(filename)))
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.truncate(total_size)
+    return name
+
+
+def write_part(session, part_number, stream, content_length, expected_checksum=None, stored_checksum=None):
+    """
+    Spool a part to a temporary file and verify its length and checksum before
+    copying it to its offset, so a failed retry never overwrites good bytes.
+    """
+    if part_number < 1 or part_number > session.part_count:
+        raise UploadError(f'Part number must be between 1 and {session.part_count}')
+
+    expected_length = session.expected_part_length(part_number)
+    if content_length is not None and content_length != expected_length:
+        raise UploadError(f'Part {part_number} must be {expected_length} bytes, got {content_length}')
+
+    digest = hashlib.sha256()
+    written = 0
+    buffer_size = settings.UPLOAD_STREAM_BUFFER_SIZE
+    path = session.dataset.original_file.path
+
+    with tempfile.TemporaryFile(dir=os.path.dirname(path)) as spool:
+        while written < expected_length:
+            chunk = stream.read(min(buffer_size, expected_length - written))
+            if not chunk:
+                break
+            spool.write(chunk)
+            digest.update(chunk)
+            written += len(chunk)
+
+        if written != expected_length:
+            raise UploadError(f'Part {part_number} is incomplete: received {written} of {expected_length} bytes')
+
+        checksum = digest.hexdigest()
+        if expected_checksum and expected_checksum.lower() != checksum:
+            raise UploadError(f'Checksum mismatch for part {part_number}')
+
+        # A streaming ingest may already have parsed the stored bytes, so they cannot change under it
+        if session.stream_ingest and stored_checksum and stored_checksum != checksum:
+            raise UploadError(f'Part {part_number} was already received with different content')
+
+        spool.seek(0)
+        with open(path, 'r+b') as f:
+            f.seek(session.part_offset(part_number))
+            shutil.copyfileobj(spool, f, buffer_size)
+
+    return written, checksum
+
+
+def abort_upload(session, reason):
+    # Conditional, so an upload that completes at the same moment is left alone
+    aborted = UploadSession.objects.filter(id=session.id, status='active').update(
+        status='aborted', updated_at=timezone.now()
+    )
+    if not aborted:
+        return False
+    session.status = 'aborted'
+    dataset = session.dataset
+    dataset.status = 'failed'
+    dataset.error_message = reason
+    dataset.save(update_fields=['status', 'error_message'])
+    return True
+
+
+def delete_upload_file(session):
+    name = session.dataset.original_file.name
+    if name and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+class UploadStreamReader(io.RawIOBase):
+    """
+    Reads an upload as its leading parts arrive, blocking until the next
+    contiguous bytes are written or the session is completed.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.path = session.dataset.original_file.path
+        self.position = 0
+        self.available = 0
+        self.last_progress = time.monotonic()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.position >= self.session.total_size:
+                return 0
+
+            if self.position < self.available:
+                length = min(len(buffer), self.available - self.position)
+                with open(self.path, 'rb') as f:
+                    f.seek(self.position)
+                    data = f.read(length)
+                buffer[:len(data)] = data
+                self.position += len(data)
+                return len(data)
+
+            self._wait_for_parts()
+
+    def _wait_for_parts(self):
+        self.session.refresh_from_db(fields=['status'])
+        if self.session.status == 'aborted':
+            raise UploadError(f'Upload {self.session.id} was aborted')
+
+        available = self.session.received_prefix_bytes()
+        if available > self.available:
+            self.available = available
+            self.last_progress = time.monotonic()
+            return
+
+        if time.monotonic() - self.last_progress > settings.UPLOAD_STREAM_IDLE_TIMEOUT:
+            raise UploadError(f'Upload {self.session.id} stalled waiting for more parts')
+        time.sleep(settings.UPLOAD_STREAM_POLL_SECONDS)
+
+
+def open_upload_stream(session):
+    return io.BufferedReader(UploadStreamReader(session), buffer_size=settings.UPLOAD_STREAM_BUFFER_SIZE)
+
+
+def get_streaming_session(dataset):
+    try:
+        session = dataset.upload_session
+    except UploadSession.DoesNotExist:
+        return None
+    if session.stream_ingest and session.status == 'active':
+        return session
+    return None
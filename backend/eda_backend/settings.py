@@ -96,6 +96,44 @@ DATABASES = {
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
+# Ingestion queues, smallest first; an upload goes to the first queue whose limit fits its estimated size.
+# Each queue has its own worker (concurrency and prefetch) in docker-compose.yml
+INGEST_QUEUES = [
+    ('ingest_small', 100 * 1024 * 1024),
+    ('ingest_medium', 2 * 1024 * 1024 * 1024),
+    ('ingest_large', None),
+]
+INGEST_COMPRESSION_FACTOR = 5
+INGEST_MAX_CONCURRENT_PER_USER = 2
+INGEST_USER_RETRY_SECONDS = 15
+# A running ingestion stops counting against its user once its heartbeat is this stale
+INGEST_HEARTBEAT_TIMEOUT = 120
+INGEST_ADMIT_TIMEOUT = 10
+INGEST_LOCK_TIMEOUT = 12 * 60 * 60
+
+# Ack after the task finishes so a long ingestion never holds prefetched small ones hostage
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'visibility_timeout': INGEST_LOCK_TIMEOUT,
+}
+# Run by the celery_beat service in docker-compose.yml
+CELERY_BEAT_SCHEDULE = {
+    'expire-upload-sessions': {
+        'task': 'core.tasks.expire_upload_sessions',
+        'schedule': 60 * 60,
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://redis:6379/1',
+    }
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -105,6 +143,10 @@ REST_FRAMEWORK = {
     ]
 }
 
+# Cursor pagination for the project and dataset lists
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -146,3 +188,36 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Chunked uploads
+UPLOAD_DIR = 'raw_datasets/'
+UPLOAD_DEFAULT_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_MIN_PART_SIZE = 1024 * 1024
+UPLOAD_MAX_PART_SIZE = 64 * 1024 * 1024
+UPLOAD_STREAM_BUFFER_SIZE = 1024 * 1024
+UPLOAD_STREAM_POLL_SECONDS = 1.0
+UPLOAD_STREAM_IDLE_TIMEOUT = 600
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024 * 1024
+# Active uploads with no new parts for this long are aborted and their files removed
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# Analytics endpoints
+ANALYTICS_CACHE_TIMEOUT = 24 * 60 * 60
+CORRELATION_CACHE_TIMEOUT = 60 * 60
+BATCH_ANALYTICS_MAX_REQUESTS = 200
+
+# Post-ingestion cache warm-up: unfiltered views plus the top values of each dimension
+CACHE_WARMING_ENABLED = True
+CACHE_WARMING_DIMENSIONS = ['brand', 'channel', 'year']
+CACHE_WARMING_TOP_N = 10
+CACHE_WARMING_TIME_BUDGET = 120
+
+# Stratified sample (by brand and year) behind ?approx=true analytics
+APPROX_SAMPLE_FRACTION = 0.01
+APPROX_SAMPLE_MIN_ROWS = 50
+
+# Streaming exports
+EXPORT_CHUNK_BYTES = 256 * 1024
+EXPORT_QUEUE_BLOCKS = 16
+EXPORT_PARQUET_ROW_GROUP = 100000
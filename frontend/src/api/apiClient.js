@@ -37,6 +37,17 @@ export const registerUser = (username, password) => apiClient.post('/register/',
 // PROJECTS
 export const getProjects = () => apiClient.get('/projects/');
 
+// Follows the cursor `next` links until the whole list is loaded
+export const getAllPages = async (request) => {
+  let res = await request();
+  const results = [...res.data.results];
+  while (res.data.next) {
+    res = await apiClient.get(res.data.next);
+    results.push(...res.data.results);
+  }
+  return results;
+};
+
 export const createProject = (projectData, file) => {
   const formData = new FormData();
   formData.append('name', projectData.name);
@@ -70,7 +70,7 @@ function DashboardPage() {
       if (datasetRes.data.status === 'completed') {
         const filtersRes = await getFilters(datasetId);
         setFilters(filtersRes.data);
-      } else if (datasetRes.data.status === 'processing') {
+      } else if (['processing', 'warming'].includes(datasetRes.data.status)) {
         setTimeout(() => fetchInitialData(), 3000);
       }
       setIsLoading(false);
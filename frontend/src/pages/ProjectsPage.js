@@ -5,7 +5,7 @@ import {
   Text, Input, Textarea, VStack, useToast, Spinner, Badge
 } from '@chakra-ui/react';
 import AppLayout from '../components/AppLayout';
-import { getProjects, createProject } from '../api/apiClient';
+import { getProjects, getAllPages, createProject } from '../api/apiClient';
 
 function ProjectsPage() {
   const [projects, setProjects] = useState([]);
@@ -23,8 +23,7 @@ function ProjectsPage() {
 
   const fetchProjects = async () => {
     try {
-      const res = await getProjects();
-      setProjects(res.data);
+      setProjects(await getAllPages(getProjects));
       setIsLoading(false);
     } catch (err) {
       console.error('Error fetching projects:', err);